@@ -9,20 +9,40 @@
 '''
 from trytond.pool import Pool
 
-from product import Product
-from sale import Sale, SaleLine
-from cart import Cart
+from product import Product, Template
+from sale import Sale, SaleLine, LatestCartSale
+from cart import Cart, CartLine, CartChange, CartArchive
 from website import Website
 from channel import SaleChannel
+from stock import Move
+from party import Party
+from price_list import PriceList, PriceListLine
+from tax import Tax
+from currency import CurrencyRate
+from user import User
+from purge import PurgeQueue
 
 
 def register():
     Pool.register(
         Product,
+        Template,
         Sale,
         SaleChannel,
         SaleLine,
         Cart,
+        CartLine,
+        CartChange,
+        CartArchive,
         Website,
+        LatestCartSale,
+        Move,
+        Party,
+        PriceList,
+        PriceListLine,
+        Tax,
+        CurrencyRate,
+        User,
+        PurgeQueue,
         type_="model", module="nereid_cart_b2c"
     )
@@ -7,27 +7,50 @@
     :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
     :license: GPLv3, see LICENSE for more details
 '''
+import datetime
+import json
+import logging
+import math
+import time
 from decimal import Decimal
-from functools import partial
 
 from nereid import jsonify, render_template, flash, request, login_required, \
-    url_for, current_user, route, context_processor, abort
+    url_for, current_user, route, context_processor, abort, cache, Response
 from nereid.contrib.locale import make_lazy_gettext
 from nereid.globals import session, current_app
+from nereid.helpers import key_from_list
+from nereid.ctx import has_request_context
+from nereid.signals import transaction_stop
+from flask import g
 from flask.ext.login import user_logged_in
 from werkzeug import redirect
-from babel import numbers
-
-
+from werkzeug.http import quote_etag
+from sql import Literal, Null, Select
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+from sql.functions import Now, CurrentTimestamp
+from sql.operators import Exists
+
+from trytond import backend
 from trytond.model import ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.tools import reduce_ids
+from trytond.transaction import Transaction
 
 from .forms import AddtoCartForm
+from .formatters import get_currency_format, get_number_format
+from .tools import clean_transaction_cache
 _ = make_lazy_gettext('nereid_cart_b2c')
 
-__all__ = ['Cart']
+__all__ = ['Cart', 'CartLine', 'CartChange', 'CartArchive']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+#: Maximum number of cart lines read at once by the paged and streamed
+#: cart views
+LINES_CHUNK_SIZE = 500
+
 
 class Cart(ModelSQL):
     """
@@ -46,6 +69,31 @@ class Cart(ModelSQL):
     sessionid = fields.Char('Session ID', select=True)
     website = fields.Many2One('nereid.website', 'Website', select=True)
 
+    #: Incremented every time the cart or the lines of its sale change. It is
+    #: used to build the ETags of the cart responses.
+    revision = fields.Integer('Revision', readonly=True)
+
+    #: Lines of guest carts kept without creating a sale, see
+    #: :meth:`stages_lines`
+    lines = fields.One2Many(
+        'nereid.cart.line', 'cart', 'Staged Lines', readonly=True
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(Cart, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+
+        # The lookup of :meth:`find_cart`
+        table.index_action(['website', 'user', 'sessionid'], 'add')
+
+    @staticmethod
+    def default_revision():
+        return 0
+
     @staticmethod
     def default_user():
         if not current_user.is_anonymous():
@@ -60,12 +108,743 @@ class Cart(ModelSQL):
         return request.nereid_website.id
 
     @classmethod
-    @context_processor('get_cart_size')
     def cart_size(cls):
         "Returns the sum of quantities in the cart"
-        cart = cls.open_cart()
-        return sum([line.quantity for line in cart.sale.lines]) \
-            if cart.sale else Decimal('0')
+        return cls.open_cart().get_summary()['quantity']
+
+    def get_summary(self):
+        """Returns the summary of the cart: the summary of its sale (see
+        :meth:`sale.sale.get_cart_summary`) if it has one, else the summary
+        of its staged lines, whose taxes are not computed yet.
+
+        The changes buffered in the session by :meth:`buffer_change` are
+        included, but their taxes are only computed once they are written to
+        the sale.
+        """
+        if self.sale:
+            return self._merge_buffered_changes(self.sale.get_cart_summary())
+
+        lines = self.lines if self.id is not None else []
+        amount = sum(
+            (line.amount for line in lines), Decimal('0')
+        )
+        return {
+            'lines': len(lines),
+            'quantity': sum(
+                (Decimal(str(line.quantity)) for line in lines),
+                Decimal('0')
+            ),
+            'untaxed_amount': amount,
+            'tax_amount': Decimal('0'),
+            'total_amount': amount,
+        }
+
+    def get_currency(self):
+        """Returns the currency of the cart: the currency of its sale, else
+        the one its lines are staged in, else the currency of the request.
+        """
+        if self.sale:
+            return self.sale.currency
+        if self.id is not None and self.lines:
+            return self.lines[0].currency
+        return request.nereid_currency
+
+    @classmethod
+    def stages_lines(cls):
+        """Returns True if the products added to the cart of the current
+        user are staged in :class:`CartLine` without creating a sale.
+
+        This is only done for guests and if the website stages guest carts,
+        as most guest carts are abandoned. The sale is created and the lines
+        are moved to it by :meth:`open_cart` when it is asked for one, like
+        at checkout, or when the guest logs in.
+        """
+        return current_user.is_anonymous() and \
+            bool(request.nereid_website.stage_guest_carts)
+
+    def stage_line(self, product_id, quantity, action='set'):
+        """Stage the product in the cart or update the quantity of its
+        staged line. The unit price is the sale price of the product for the
+        current user, see :meth:`product.product.sale_price`.
+
+        :param product_id: ID of the product
+        :param quantity: Quantity
+        :param action: set - set the quantity to the given quantity
+                       add - add quantity to existing quantity
+        :return: The saved :class:`CartLine`
+        """
+        CartLine = Pool().get('nereid.cart.line')
+        Product = Pool().get('product.product')
+
+        product = Product(product_id)
+        lines = CartLine.search([
+            ('cart', '=', self.id),
+            ('product', '=', product_id),
+        ], limit=1)
+        if lines:
+            line, = lines
+            if action == 'add':
+                quantity += line.quantity
+        else:
+            line = CartLine(
+                cart=self, product=product, unit=product.sale_uom
+            )
+        line.quantity = quantity
+        line.unit_price = product.sale_price(quantity)
+        line.currency = request.nereid_currency
+        line.save()
+        return line
+
+    def materialize_lines(self, sale=None):
+        """Move the staged lines of the cart to a sale, where they are
+        priced and taxed like the lines added to a sale. The new sale lines
+        are created together.
+
+        :param sale: Active record of the sale, the sale of the cart if not
+                     given
+        """
+        SaleLine = Pool().get('sale.line')
+        CartLine = Pool().get('nereid.cart.line')
+
+        sale = sale or self.sale
+        staged_lines = CartLine.search([('cart', '=', self.id)])
+        if not staged_lines:
+            return
+
+        new_lines = []
+        for staged_line in staged_lines:
+            sale_line = sale._add_or_update(
+                staged_line.product.id, staged_line.quantity, 'add'
+            )
+            if sale_line.id is None or sale_line.id < 0:
+                new_lines.append(sale_line.get_cart_create_values())
+            else:
+                sale_line.save()
+        if new_lines:
+            SaleLine.create(new_lines)
+        CartLine.delete(staged_lines)
+
+    @classmethod
+    def buffers_changes(cls):
+        """Returns True if the products added to the carts of the website
+        are buffered by :meth:`buffer_change` instead of being written to
+        the sale right away.
+        """
+        return bool(request.nereid_website.buffer_cart_changes)
+
+    @staticmethod
+    def _get_database_now():
+        """Returns the current time of the database clock, which also sets
+        the creation date of the buffered changes, so that their age does
+        not depend on the clock of the server handling the request.
+        """
+        cursor = Transaction().cursor
+        cursor.execute(*Select([CurrentTimestamp()]))
+        now, = cursor.fetchone()
+        if isinstance(now, basestring):
+            # SQLite returns the time as text
+            now = datetime.datetime.strptime(
+                now, '%Y-%m-%d %H:%M:%S.%f' if '.' in now
+                else '%Y-%m-%d %H:%M:%S'
+            )
+        return now
+
+    def get_buffered_changes(self):
+        """Returns the changes of the cart buffered by :meth:`buffer_change`,
+        as a list of `(product ID, quantity, action)` in the order they were
+        made.
+        """
+        CartChange = Pool().get('nereid.cart.change')
+
+        if self.id is None:
+            return []
+        change = CartChange.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*change.select(
+            change.product, change.quantity, change.action,
+            where=change.cart == self.id, order_by=change.id.asc
+        ))
+        return cursor.fetchall()
+
+    def get_last_change_id(self):
+        """Returns the ID of the last change of the cart buffered by
+        :meth:`buffer_change`, or 0. It is part of the ETag of the cart.
+        """
+        CartChange = Pool().get('nereid.cart.change')
+
+        if self.id is None:
+            return 0
+        change = CartChange.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*change.select(
+            Max(change.id), where=change.cart == self.id
+        ))
+        return cursor.fetchone()[0] or 0
+
+    def buffer_change(self, product_id, quantity, action='set'):
+        """Add the change of the quantity of a product to the journal of the
+        cart instead of writing the line of its sale, so that a burst of
+        changes, like the clicks on a quantity stepper, writes the sale once.
+
+        Each change is a single insert in the journal, so concurrent changes
+        never conflict. The revision of the cart is not incremented, the
+        ETag of the cart changes with its last buffered change instead.
+
+        The buffered changes are written by :meth:`flush_changes` once there
+        are as many as the buffer size of the website, by the scheduler
+        once the first one is older than its buffer delay (see
+        :meth:`flush_expired_changes`), and before the cart is viewed,
+        changed line by line, checked out or merged at login.
+
+        :param product_id: ID of the product
+        :param quantity: Quantity
+        :param action: set - set the quantity to the given quantity
+                       add - add quantity to existing quantity
+        """
+        CartChange = Pool().get('nereid.cart.change')
+
+        change = CartChange.__table__()
+        cursor = Transaction().cursor
+
+        CartChange.create([{
+            'cart': self.id,
+            'product': product_id,
+            'quantity': quantity,
+            'action': action,
+        }])
+        # The merged state of the cart changes
+        self.forget_request_carts()
+
+        cursor.execute(*change.select(
+            Count(change.id), where=change.cart == self.id
+        ))
+        if cursor.fetchone()[0] >= \
+                (request.nereid_website.cart_buffer_size or 1):
+            self.flush_changes()
+
+    def _get_merged_lines(self, changes):
+        """Returns a dictionary mapping the ID of each product of the given
+        buffered changes to its line in the sale of the cart, or None, and
+        its quantity once the changes are applied in order.
+
+        :param changes: List of buffered changes of the cart, see
+                        :meth:`get_buffered_changes`
+        """
+        SaleLine = Pool().get('sale.line')
+
+        sale_lines = SaleLine.search([
+            ('sale', '=', self.sale.id),
+            ('product', 'in', list(set(change[0] for change in changes))),
+        ])
+        lines = {}
+        for line in sale_lines:
+            # Like find_existing_line, use the first line of the product
+            lines.setdefault(line.product.id, line)
+
+        quantities = {}
+        for product_id, quantity, action in changes:
+            if action == 'add':
+                line = lines.get(product_id)
+                quantities[product_id] = quantities.get(
+                    product_id, line.quantity if line else 0
+                ) + quantity
+            else:
+                quantities[product_id] = quantity
+        return dict(
+            (product_id, (lines.get(product_id), quantity))
+            for product_id, quantity in quantities.iteritems()
+        )
+
+    def _merge_buffered_changes(self, summary):
+        """Returns the summary of the sale of the cart with its buffered
+        changes. The new lines are priced with the sale price of their
+        product and the taxes of the changes are not included.
+
+        :param summary: The summary of the sale, see
+                        :meth:`sale.sale.get_cart_summary`
+        """
+        Product = Pool().get('product.product')
+
+        changes = self.get_buffered_changes()
+        if not changes:
+            return summary
+
+        summary = dict(summary)
+        for product_id, (line, quantity) in \
+                self._get_merged_lines(changes).iteritems():
+            if line:
+                old_quantity, unit_price = line.quantity, line.unit_price
+            else:
+                old_quantity = 0
+                unit_price = Product(product_id).sale_price(quantity)
+                summary['lines'] += 1
+            summary['quantity'] += quantity - old_quantity
+            amount = self.sale.currency.round(
+                Decimal(str(quantity - old_quantity)) * unit_price
+            )
+            summary['untaxed_amount'] += amount
+            summary['total_amount'] += amount
+        return summary
+
+    def _serialize_pending_line(self, product_id, line, quantity):
+        """Serialize a line of the cart with buffered changes. Such lines are
+        marked as `pending` and have no amount yet.
+
+        :param product_id: ID of the product
+        :param line: Active record of the sale line of the product or None
+        :param quantity: Quantity once the buffered changes are applied
+        """
+        Product = Pool().get('product.product')
+
+        if line:
+            data = line.serialize(purpose='cart')
+            del data['amount']
+        else:
+            data = {
+                'product': Product(product_id).serialize(purpose='cart'),
+            }
+        data['quantity'] = get_number_format(
+            request.nereid_language.code
+        )(quantity)
+        data['pending'] = True
+        return data
+
+    def serialize_buffered_line(self, product_id):
+        """Serialize the line of the product in the cart, with its buffered
+        changes, for the response of :meth:`add_to_cart`.
+
+        :param product_id: ID of the product
+        """
+        changes = [
+            change for change in self.get_buffered_changes()
+            if change[0] == product_id
+        ]
+        if not changes:
+            line = self.sale.find_existing_line(product_id)
+            return line.serialize(purpose='cart') if line else {}
+
+        (line, quantity), = self._get_merged_lines(changes).values()
+        return self._serialize_pending_line(product_id, line, quantity)
+
+    def serialize_lines(self):
+        """Serialize the lines of the cart like
+        :meth:`sale.line.serialize_cart_lines`, with the buffered changes,
+        see :meth:`serialize_buffered_line`. The staged lines are serialized
+        if the cart has no sale.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        if not self.sale:
+            if self.id is None:
+                return []
+            return [line.serialize(purpose='cart') for line in self.lines]
+
+        changes = self.get_buffered_changes()
+        merged_lines = self._get_merged_lines(changes) if changes else {}
+        pending = dict(
+            (line.id, (product_id, line, quantity))
+            for product_id, (line, quantity) in merged_lines.iteritems()
+            if line
+        )
+        res = []
+        for data in SaleLine.serialize_cart_lines(self.sale.lines):
+            if data['id'] in pending:
+                data = self._serialize_pending_line(*pending[data['id']])
+            res.append(data)
+        for product_id, (line, quantity) in merged_lines.iteritems():
+            if not line:
+                res.append(
+                    self._serialize_pending_line(product_id, line, quantity)
+                )
+        return res
+
+    def flush_changes(self):
+        """Write the buffered changes of the cart to its sale. The changed
+        lines are repriced and written together by
+        :meth:`sale.sale.update_cart_lines` and the new lines are created
+        together.
+
+        The changes are removed from the journal first, so that a concurrent
+        flush of the same changes fails instead of applying them twice. They
+        are dropped if the sale is no longer a draft.
+        """
+        SaleLine = Pool().get('sale.line')
+        CartChange = Pool().get('nereid.cart.change')
+
+        if self.id is None:
+            return
+        change = CartChange.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*change.select(
+            change.id, change.product, change.quantity, change.action,
+            where=change.cart == self.id, order_by=change.id.asc
+        ))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        change_ids = [row[0] for row in rows]
+        cursor.execute(*change.delete(
+            where=reduce_ids(change.id, change_ids)
+        ))
+        if cursor.rowcount != len(change_ids):
+            # Flushed by another transaction
+            return
+        self.forget_request_carts()
+
+        if not self.sale or self.sale.state != 'draft':
+            return
+        quantities, new_lines = {}, []
+        for product_id, (line, quantity) in \
+                self._get_merged_lines([row[1:] for row in rows]).iteritems():
+            if line:
+                quantities[line] = quantity
+            else:
+                new_lines.append(self.sale._add_or_update(
+                    product_id, quantity, 'set'
+                ).get_cart_create_values())
+        self.sale.update_cart_lines(quantities=quantities)
+        if new_lines:
+            SaleLine.create(new_lines)
+
+    @classmethod
+    def flush_sale_changes(cls, sales):
+        """Write the buffered changes of the carts of the given sales, see
+        :meth:`flush_changes`.
+
+        :param sales: List of sale active records
+        """
+        for cart in cls.search([('sale', 'in', map(int, sales))]):
+            cart.flush_changes()
+
+    @classmethod
+    def flush_user_changes(cls):
+        """Write the buffered changes of the cart of the current user, see
+        :meth:`flush_changes`.
+
+        :return: Active record of the cart or None
+        """
+        cart = cls.find_cart(current_user.id)
+        if cart:
+            cart.flush_changes()
+        return cart
+
+    @classmethod
+    def flush_expired_changes(cls):
+        """Write the buffered changes of the carts whose first change is
+        older than the buffer delay of their website by the database clock.
+        The changes of the websites which no longer buffer cart changes are
+        all written. Called by the scheduler.
+        """
+        Website = Pool().get('nereid.website')
+        CartChange = Pool().get('nereid.cart.change')
+
+        cart = cls.__table__()
+        change = CartChange.__table__()
+        cursor = Transaction().cursor
+
+        now = cls._get_database_now()
+        cart_ids = set()
+        for website in Website.search([]):
+            limit_date = now
+            if website.buffer_cart_changes:
+                limit_date -= datetime.timedelta(
+                    seconds=website.cart_buffer_delay or 0
+                )
+            cursor.execute(*change.join(
+                cart, condition=change.cart == cart.id
+            ).select(
+                change.cart,
+                where=(cart.website == website.id)
+                & (change.create_date <= limit_date),
+                group_by=change.cart
+            ))
+            cart_ids.update(row[0] for row in cursor.fetchall())
+
+        for cart in cls.browse(sorted(cart_ids)):
+            cart.flush_changes()
+
+    @classmethod
+    @context_processor('get_cart')
+    def get_request_cart(cls):
+        """Returns the cart of the current user, see :meth:`open_cart`.
+
+        The cart is only opened when a template first calls `get_cart` and
+        is shared by all the calls made while handling the request, until
+        the cart changes.
+        """
+        carts = cls._get_request_carts()
+        key = ('cart', current_user.id)
+        if key not in carts:
+            carts[key] = cls.open_cart()
+        return carts[key]
+
+    @classmethod
+    @context_processor('get_cart_size')
+    def get_request_cart_size(cls):
+        """Returns the sum of quantities in the cart, see :meth:`cart_size`.
+
+        It is computed when a template first calls `get_cart_size` and is
+        shared like :meth:`get_request_cart`.
+        """
+        carts = cls._get_request_carts()
+        key = ('size', current_user.id)
+        if key not in carts:
+            carts[key] = cls.get_request_cart().get_summary()['quantity']
+        return carts[key]
+
+    @staticmethod
+    def _get_request_carts():
+        "Returns the carts and sizes shared while handling the request"
+        if not hasattr(g, 'request_carts'):
+            g.request_carts = {}
+        return g.request_carts
+
+    @staticmethod
+    def forget_request_carts():
+        """Forget the carts and sizes shared while handling the request, so
+        that they are found again the next time a template asks for them.
+        This is called whenever a cart changes.
+
+        The dictionary is cleared rather than replaced, as the cart opened by
+        :meth:`get_request_cart` may change while it is being opened and is
+        then stored in the same dictionary.
+        """
+        if has_request_context() and hasattr(g, 'request_carts'):
+            g.request_carts.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls.forget_request_carts()
+        return super(Cart, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.forget_request_carts()
+        super(Cart, cls).write(*args)
+
+        actions = iter(args)
+        carts = []
+        for records, values in zip(actions, actions):
+            if 'sale' in values:
+                carts.extend(records)
+        cls.bump_revision(carts=carts)
+
+    @classmethod
+    def delete(cls, carts):
+        cls.forget_request_carts()
+        super(Cart, cls).delete(carts)
+
+    @classmethod
+    def bump_revision(cls, carts=None, sales=None):
+        """
+        Increment the revision of the given carts and of the carts of the
+        given sales.
+
+        The increment is done by the database with a single update, so that
+        concurrent changes of a cart are never lost. The write date of the
+        carts is updated as well, so that it is the date of the last change
+        of the cart or its lines.
+
+        :param carts: List of cart active records or IDs
+        :param sales: List of sale active records or IDs
+        """
+        cart = cls.__table__()
+        cursor = Transaction().cursor
+
+        cls.forget_request_carts()
+
+        cart_ids = set(map(int, carts or []))
+        if sales:
+            cursor.execute(*cart.select(
+                cart.id, where=reduce_ids(cart.sale, map(int, sales))
+            ))
+            cart_ids.update(row[0] for row in cursor.fetchall())
+        if not cart_ids:
+            return
+
+        cursor.execute(*cart.update(
+            columns=[cart.revision, cart.write_uid, cart.write_date],
+            values=[
+                Coalesce(cart.revision, 0) + 1, Transaction().user, Now()
+            ],
+            where=reduce_ids(cart.id, list(cart_ids))
+        ))
+
+        clean_transaction_cache(cls.__name__, cart_ids)
+
+    def get_etag(self, variant):
+        """
+        Returns a strong ETag for a response showing the cart. It changes
+        whenever the revision of the cart changes or a change of the cart is
+        buffered.
+
+        :param variant: Name of the kind of response, as the same cart is
+                        rendered differently by each view
+        """
+        return key_from_list([
+            Transaction().cursor.dbname,
+            'nereid.cart',
+            variant,
+            self.id,
+            self.revision if self.id else 0,
+            self.get_last_change_id(),
+            current_user.id,
+            request.nereid_language.code,
+            request.nereid_currency.id,
+        ])
+
+    @staticmethod
+    def set_private_cache_headers(response):
+        """
+        Set the caching headers of a response showing the cart. It belongs to
+        the session of the visitor while its URL is the same for everyone, so
+        it must never be stored by a shared cache. The browser revalidates it
+        with its ETag.
+
+        :param response: The response object or lazy renderer
+        """
+        response.headers['Cache-Control'] = 'private, max-age=0'
+        response.headers['Vary'] = 'Cookie'
+
+    @classmethod
+    def get_not_modified_response(cls, variant, renders_flashes=False):
+        """
+        Returns a `304 Not Modified` response if the ETag sent by the client
+        in `If-None-Match` is the current one for the variant, else None.
+
+        Only the cart itself is read to find it out.
+
+        :param variant: Name of the kind of response, see :meth:`get_etag`
+        :param renders_flashes: True if the response is rendered by a
+                                template which may show the flashed messages.
+                                They are not part of the ETag, so such a
+                                response is always sent while there are any.
+        """
+        if not request.if_none_match:
+            return None
+        if renders_flashes and session.get('_flashes'):
+            return None
+
+        cart = cls.find_cart(current_user.id) or cls(user=current_user.id)
+        etag = cart.get_etag(variant)
+        if etag not in request.if_none_match:
+            return None
+
+        response = Response(status=304)
+        response.headers['ETag'] = quote_etag(etag)
+        cls.set_private_cache_headers(response)
+        return response
+
+    @classmethod
+    def archive_retired_carts(
+            cls, delay=1, draft_delay=None, chunk_size=500, commit=False):
+        """
+        Move the retired carts of registered users from the cart table to
+        the :class:`CartArchive` table, so that the cart table which is
+        searched by :meth:`find_cart` only has the carts in use.
+
+        A cart is retired if it has no sale or its sale is no longer a
+        draft, and it has not changed for `delay` days. The user gets a new
+        cart the next time one is needed.
+
+        If `draft_delay` is given, the carts with a draft sale which have
+        not changed for `draft_delay` days are archived as well. The draft
+        sale itself is kept with the cart archive pointing to it, and
+        :meth:`open_cart` picks it again as an abandoned cart when the user
+        adds a product to a new cart.
+
+        The carts are copied and deleted by chunks ordered by their ID, with
+        a single insert and a single delete per chunk. The carts which still
+        have staged lines (see :meth:`stages_lines`) are never archived, as
+        their lines would be deleted with them, nor those with buffered
+        changes (see :meth:`buffer_change`) until they are written.
+
+        :param delay: Number of days after which a retired cart is archived
+        :param draft_delay: Number of days after which a cart with a draft
+                            sale is archived. Such carts are never archived if
+                            not given.
+        :param chunk_size: Number of carts archived per chunk
+        :param commit: If True the transaction is committed after each chunk
+        :return: Number of carts archived
+        """
+        Sale = Pool().get('sale.sale')
+        CartLine = Pool().get('nereid.cart.line')
+        CartChange = Pool().get('nereid.cart.change')
+        CartArchive = Pool().get('nereid.cart.archive')
+
+        cart = cls.__table__()
+        sale = Sale.__table__()
+        line = CartLine.__table__()
+        change = CartChange.__table__()
+        archive = CartArchive.__table__()
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        now = datetime.datetime.now()
+        last_change = Coalesce(cart.write_date, cart.create_date)
+        retired = (
+            (cart.sale == Null) | (sale.state != 'draft')
+        ) & (last_change < now - datetime.timedelta(days=delay))
+        if draft_delay is not None:
+            retired |= (sale.state == 'draft') & (
+                last_change < now - datetime.timedelta(days=draft_delay)
+            )
+        retired &= ~Exists(line.select(line.id, where=line.cart == cart.id))
+        retired &= ~Exists(
+            change.select(change.id, where=change.cart == cart.id)
+        )
+
+        done, start, last_id = 0, time.time(), 0
+        while True:
+            cursor.execute(*cart.join(
+                sale, 'LEFT', condition=cart.sale == sale.id
+            ).select(
+                cart.id,
+                where=(cart.user != Null) & (cart.id > last_id) & retired,
+                order_by=cart.id.asc, limit=chunk_size
+            ))
+            cart_ids = [row[0] for row in cursor.fetchall()]
+            if not cart_ids:
+                break
+
+            cursor.execute(*archive.insert(
+                columns=[
+                    archive.create_uid, archive.create_date, archive.cart,
+                    archive.user, archive.sessionid, archive.website,
+                    archive.sale, archive.revision, archive.cart_create_date,
+                    archive.cart_write_date,
+                ],
+                values=cart.select(
+                    Literal(transaction.user), Now(), cart.id,
+                    cart.user, cart.sessionid, cart.website,
+                    cart.sale, cart.revision, cart.create_date,
+                    cart.write_date,
+                    where=reduce_ids(cart.id, cart_ids)
+                )
+            ))
+            cursor.execute(*cart.delete(
+                where=reduce_ids(cart.id, cart_ids)
+            ))
+
+            last_id = cart_ids[-1]
+            done += len(cart_ids)
+            logger.info(
+                'Archived %d carts (%.1f carts/s, last cart ID: %d)',
+                done, done / (time.time() - start), last_id
+            )
+            if commit:
+                cursor.commit()
+
+        clean_transaction_cache(cls.__name__)
+        return done
+
+    @classmethod
+    def archive_retired_carts_from_cron(cls):
+        """
+        Archive the retired carts. Called by the scheduler.
+        """
+        return cls.archive_retired_carts(commit=True)
 
     @classmethod
     @login_required
@@ -86,50 +865,364 @@ class Cart(ModelSQL):
 
         For XHTTP/Ajax Requests a JSON object with order and lines information
         which should be sufficient to show order information is returned.
+        The following arguments are accepted:
+
+            * `fields`: Limits it to the given attributes, see
+              :meth:`_parse_xhr_cart_fields`.
+            * `limit` and `after`: Return at most `limit` lines, starting
+              after the line with the ID given in `after`. The lines are then
+              ordered by ID and the ID to use as `after` for the next page is
+              returned as `next`, or null on the last page.
+            * `stream`: If set to 1, the lines are read from the database
+              and serialized in chunks, so that the records of all the lines
+              of a very large cart are never held in memory.
+
+        The responses have an ETag which changes with the revision of the
+        cart and requests with a matching `If-None-Match` header get a
+        `304 Not Modified` response.
         """
+        # The lines are shown as they are in the sale
+        cart = cls.flush_user_changes()
+        if cart and cart.sale:
+            # The shopper is told about the prices changed by the scheduler
+            # like about those changed when a product is added
+            cart.sale.notify_price_changes()
+
+        if request.is_xhr:
+            variant = 'json:%s' % request.query_string
+        else:
+            variant = 'html'
+        response = cls.get_not_modified_response(
+            variant, renders_flashes=not request.is_xhr
+        )
+        if response is not None:
+            return response
+
         cart = cls.open_cart()
 
         if request.is_xhr:
-            if not cart.sale:
+            if not cart.sale and not (cart.id is not None and cart.lines):
                 # Dont try to build further if the cart is empty
-                return jsonify({'empty': True})
+                response = jsonify({'empty': True})
+            else:
+                cart_fields, line_fields = cls._parse_xhr_cart_fields(
+                    request.args.get('fields')
+                )
+                # Staged carts are small enough to be sent at once
+                if cart.sale and request.args.get('stream', 0, type=int):
+                    response = cls._stream_xhr_cart(
+                        cart, cart_fields, line_fields
+                    )
+                else:
+                    response = jsonify(cart=cls._get_xhr_cart_data(
+                        cart, cart_fields, line_fields,
+                        after=request.args.get('after', 0, type=int),
+                        limit=request.args.get('limit', type=int),
+                    ))
+            response.headers['ETag'] = quote_etag(cart.get_etag(variant))
+            cls.set_private_cache_headers(response)
+            return response
+
+        # The lines and summary work for staged carts, which have no sale
+        response = render_template(
+            'shopping-cart.jinja', cart=cart, lines=cart.serialize_lines(),
+            summary=cart.get_summary()
+        )
+        response.headers['ETag'] = quote_etag(cart.get_etag(variant))
+        cls.set_private_cache_headers(response)
+        return response
 
-            # Build locale formatters
-            currency_format = partial(
-                numbers.format_currency, currency=cart.sale.currency.code,
-                locale=request.nereid_language.code
-            )
-            number_format = partial(
-                numbers.format_number, locale=request.nereid_language.code
-            )
-            return jsonify(cart={
-                'lines': [{
-                    'product': l.product and l.product.name or None,
-                    'quantity': number_format(l.quantity),
-                    'unit': l.unit.symbol,
-                    'unit_price': currency_format(l.unit_price),
-                    'amount': currency_format(l.amount),
-                } for l in cart.sale.lines],
-                'empty': len(cart.sale.lines) > 0,
-                'total_amount': currency_format(cart.sale.total_amount),
-                'tax_amount': currency_format(cart.sale.tax_amount),
-                'untaxed_amount': currency_format(cart.sale.untaxed_amount),
-            })
-
-        response = render_template('shopping-cart.jinja', cart=cart)
-        response.headers['Cache-Control'] = 'max-age=0'
+    @staticmethod
+    def _parse_xhr_cart_fields(fields=None):
+        """Returns the set of the attributes of the cart and the set of the
+        attributes of the lines to send in the XHR response of
+        :meth:`view_cart`.
+
+        The attributes of the cart are `lines`, `empty`, `total_amount`,
+        `tax_amount` and `untaxed_amount`. The attributes of the lines are
+        `id`, `product`, `quantity`, `unit`, `unit_price` and `amount`. Only
+        the attributes which are asked for are computed.
+
+        Aborts with a 400 if an unknown attribute is asked for.
+
+        :param fields: Comma separated names of the attributes to return,
+                       where the attributes of lines are given as
+                       `lines.<name>`, eg: `lines.id,lines.quantity`. Asking
+                       for `lines` returns all the attributes of the lines
+                       but `id`. If not given, all the attributes but the
+                       `id` of lines are returned.
+        """
+        all_cart_fields = set([
+            'lines', 'empty', 'total_amount', 'tax_amount', 'untaxed_amount'
+        ])
+        all_line_fields = set([
+            'id', 'product', 'quantity', 'unit', 'unit_price', 'amount'
+        ])
+        default_line_fields = all_line_fields - set(['id'])
+
+        if not fields:
+            return all_cart_fields, default_line_fields
+
+        cart_fields, line_fields = set(), set()
+        for name in fields.split(','):
+            name = name.strip()
+            if name == 'lines':
+                line_fields.update(default_line_fields)
+            elif name.startswith('lines.'):
+                name, line_field = name.split('.', 1)
+                line_fields.add(line_field)
+            cart_fields.add(name)
+        if not cart_fields <= all_cart_fields or \
+                not line_fields <= all_line_fields:
+            abort(400)
+        return cart_fields, line_fields
+
+    @staticmethod
+    def _get_xhr_line_serializer(cart, line_fields):
+        """Returns a function which serializes a line of the cart for the XHR
+        response of :meth:`view_cart`.
+
+        The locale formatters are looked up here, so the function can be
+        called once the request is over.
+
+        :param cart: Active record of a cart which has a sale or staged
+                     lines
+        :param line_fields: Set of the attributes of the lines to return
+        """
+        currency = cart.get_currency()
+        currency_format = get_currency_format(
+            currency.code, request.nereid_language.code
+        )
+        number_format = get_number_format(request.nereid_language.code)
+
+        line_getters = {
+            'id': lambda line: line.id,
+            'product': lambda line: line.product and line.product.name or None,
+            'quantity': lambda line: number_format(line.quantity),
+            'unit': lambda line: line.unit.symbol,
+            'unit_price': lambda line: currency_format(line.unit_price),
+            'amount': lambda line: currency_format(line.amount),
+        }
+        return lambda line: dict(
+            (name, line_getters[name](line)) for name in line_fields
+        )
+
+    @staticmethod
+    def _get_cart_lines_page(
+            sale_id, after=0, limit=LINES_CHUNK_SIZE, cart_id=None):
+        """Returns at most `limit` lines of the sale ordered by ID, starting
+        after the line with the ID `after`.
+
+        The lines are found with the primary key index, so reading any page
+        costs the same whatever the size of the cart.
+
+        If `sale_id` is None, the staged lines of the cart with the ID
+        `cart_id` are returned instead.
+        """
+        if sale_id is None:
+            Line = Pool().get('nereid.cart.line')
+            domain = [('cart', '=', cart_id)]
+        else:
+            Line = Pool().get('sale.line')
+            domain = [('sale', '=', sale_id)]
+
+        return Line.search(domain + [
+            ('id', '>', after),
+        ], order=[('id', 'ASC')], limit=limit)
+
+    @classmethod
+    def _get_xhr_cart_data(
+            cls, cart, cart_fields, line_fields, after=0, limit=None):
+        """Returns the data of the cart sent by :meth:`view_cart` for XHR
+        requests.
+
+        :param cart: Active record of a cart which has a sale or staged
+                     lines
+        :param cart_fields: Set of the attributes of the cart to return
+        :param line_fields: Set of the attributes of the lines to return
+        :param after: ID of the line after which the page of lines starts
+        :param limit: Maximum number of lines to return, if not given all the
+                      lines are returned and not paged.
+        """
+        currency = cart.get_currency()
+        currency_format = get_currency_format(
+            currency.code, request.nereid_language.code
+        )
+        serialize_line = cls._get_xhr_line_serializer(cart, line_fields)
+        data = {}
+
+        if 'lines' in cart_fields:
+            if limit is None and not after:
+                lines = cart.sale.lines if cart.sale else cart.lines
+            else:
+                limit = min(max(limit or LINES_CHUNK_SIZE, 1), LINES_CHUNK_SIZE)
+                # Read one more line to find out if there is a next page
+                lines = cls._get_cart_lines_page(
+                    cart.sale and cart.sale.id, after, limit + 1,
+                    cart_id=cart.id
+                )
+                data['next'] = lines[limit - 1].id \
+                    if len(lines) > limit else None
+                lines = lines[:limit]
+            data['lines'] = map(serialize_line, lines)
+
+        if cart_fields & set([
+                'empty', 'total_amount', 'tax_amount', 'untaxed_amount']):
+            summary = cart.get_summary()
+            for name in ('total_amount', 'tax_amount', 'untaxed_amount'):
+                if name in cart_fields:
+                    data[name] = currency_format(summary[name])
+            if 'empty' in cart_fields:
+                data['empty'] = summary['lines'] > 0
+
+        return data
+
+    @classmethod
+    def _stream_xhr_cart(cls, cart, cart_fields, line_fields):
+        """Returns a response streaming the XHR data of the cart sent by
+        :meth:`view_cart`.
+
+        The lines are read and serialized by chunks of `LINES_CHUNK_SIZE`
+        lines, so that only the JSON of the lines is held in memory and not
+        their records. They are all read within the transaction of the
+        request, before the response is sent, so that they are the lines of
+        the revision of the cart in the ETag and of the totals of the cart.
+
+        :param cart: Active record of a cart which has a sale
+        :param cart_fields: Set of the attributes of the cart to return
+        :param line_fields: Set of the attributes of the lines to return
+        """
+        data = cls._get_xhr_cart_data(
+            cart, cart_fields - set(['lines']), line_fields
+        )
+        serialize_line = cls._get_xhr_line_serializer(cart, line_fields)
+
+        chunks = []
+        if 'lines' in cart_fields:
+            after = 0
+            while True:
+                lines = cls._get_cart_lines_page(cart.sale.id, after)
+                if not lines:
+                    break
+                chunks.append(', '.join(
+                    json.dumps(serialize_line(line)) for line in lines
+                ))
+                after = lines[-1].id
+
+        def generate():
+            # Open the cart object but leave it unclosed to add the lines
+            yield '{"cart": %s' % json.dumps(data)[:-1]
+            if 'lines' in cart_fields:
+                yield '%s"lines": [' % (', ' if data else '')
+                for index, chunk in enumerate(chunks):
+                    yield (', ' if index else '') + chunk
+                yield ']'
+            yield '}}'
+
+        return Response(generate(), mimetype='application/json')
+
+    @classmethod
+    @route('/cart/summary')
+    def view_cart_summary(cls):
+        """Returns the number of items, the quantity and the formatted total
+        of the cart as JSON. This is meant for mini carts in page headers
+        which only need these and poll them often.
+
+        The response has an ETag which changes with the revision of the cart.
+        A request with a matching `If-None-Match` header gets a
+        `304 Not Modified` response after reading only the cart, and the
+        summary for an ETag is cached.
+        """
+        response = cls.get_not_modified_response('summary')
+        if response is not None:
+            return response
+
+        cart = cls.open_cart()
+        currency = cart.get_currency()
+
+        etag = cart.get_etag('summary')
+        summary = cache.get(etag)
+        if summary is None:
+            summary = cls._get_summary_data(cart, currency)
+            cache.set(etag, summary, 60 * 5)
+        response = jsonify(summary)
+        response.headers['ETag'] = quote_etag(etag)
+        cls.set_private_cache_headers(response)
         return response
 
+    @classmethod
+    def _get_summary_data(cls, cart, currency):
+        """Returns the dictionary sent by :meth:`view_cart_summary`
+
+        :param cart: Active record of the cart
+        :param currency: Active record of the currency of the cart
+        """
+        currency_format = get_currency_format(
+            currency.code, request.nereid_language.code
+        )
+        summary = cart.get_summary()
+        return {
+            'items': summary['lines'],
+            # The sum is a Decimal on PostgreSQL and for staged carts
+            'quantity': float(summary['quantity']),
+            'total_amount': currency_format(summary['total_amount']),
+        }
+
+    @classmethod
+    def _get_changed_cart_data(cls, cart):
+        """Returns the state of the cart sent with the XHR responses of
+        :meth:`add_to_cart`, :meth:`delete_from_cart` and :meth:`clear_cart`
+        when the `summary` argument is set to 1, so that the client does not
+        have to fetch the cart again after changing it.
+
+        It is the data of :meth:`view_cart_summary` with the `revision` of
+        the cart, which can be compared with the one of an earlier response.
+
+        :param cart: Active record of the cart once changed
+        """
+        currency = cart.get_currency()
+        data = cls._get_summary_data(cart, currency)
+        # The revision is incremented by the database, so read it again
+        data['revision'] = cls(cart.id).revision if cart.id else 0
+        return data
+
     @classmethod
     @route('/esi/cart')
     def view_cart_esi(cls):
         """Returns a view of the shopping cart
 
         Similar to :meth:view_cart but for ESI
+
+        The rendered fragment of a cart is cached with the ETag of the cart
+        as the key, which changes with the cart, its language and currency.
+        A change of the cart increments its revision, so the fragments of the
+        older revisions are never served again and expire from the cache.
+
+        The buffered changes of the cart are shown merged with its sale, see
+        :meth:`serialize_lines`, as the route is read only.
         """
+        response = cls.get_not_modified_response('esi', renders_flashes=True)
+        if response is not None:
+            return response
+
         cart = cls.open_cart()
-        response = render_template('shopping-cart-esi.jinja', cart=cart)
-        response.headers['Cache-Control'] = 'max-age=0'
+        etag = cart.get_etag('esi')
+
+        # The fragment is not cached if it is not specific to a cart, or if
+        # it could show flashed messages
+        use_cache = cart.id is not None and not session.get('_flashes')
+        fragment = cache.get(etag) if use_cache else None
+        if fragment is None:
+            fragment = unicode(render_template(
+                'shopping-cart-esi.jinja', cart=cart,
+                lines=cart.serialize_lines(), summary=cart.get_summary()
+            ))
+            if use_cache:
+                cache.set(etag, fragment, 60 * 5)
+
+        response = Response(fragment, mimetype='text/html')
+        response.headers['ETag'] = quote_etag(etag)
+        cls.set_private_cache_headers(response)
         return response
 
     def _clear_cart(self):
@@ -151,10 +1244,20 @@ class Cart(ModelSQL):
     def clear_cart(cls):
         """
         Clears the current cart and redirects to shopping cart page
+
+        For XHR requests with the `summary` argument set to 1, the state of
+        the emptied cart is returned instead, see
+        :meth:`_get_changed_cart_data`.
         """
         cart = cls.open_cart()
         cart._clear_cart()
-        flash(_('Your shopping cart has been cleared'))
+        message = _('Your shopping cart has been cleared')
+        if request.is_xhr and request.values.get('summary', 0, type=int):
+            return jsonify(
+                message=unicode(message),
+                cart=cls._get_changed_cart_data(cls.open_cart()),
+            )
+        flash(message)
         return redirect(url_for('nereid.cart.view_cart'))
 
     @classmethod
@@ -166,14 +1269,27 @@ class Cart(ModelSQL):
         :param user: ID of the user
         :return: Active record of cart or None
         """
+        carts = cls.search(cls._get_find_cart_domain(
+            request.nereid_website.id, user, session.sid
+        ), limit=1)
+        return carts[0] if carts else None
+
+    @staticmethod
+    def _get_find_cart_domain(website_id, user_id, sessionid):
+        """Returns the domain of the cart searched by :meth:`find_cart`. It
+        is matched by the index on website, user and sessionid.
+
+        :param website_id: ID of the website
+        :param user_id: ID of the user or None for a guest cart
+        :param sessionid: ID of the session, only used for guest carts
+        """
         domain = [
-            ('website', '=', request.nereid_website.id),
-            ('user', '=', user),
+            ('website', '=', website_id),
+            ('user', '=', user_id),
         ]
-        if not user:
-            domain.append(('sessionid', '=', session.sid))
-        carts = cls.search(domain, limit=1)
-        return carts[0] if carts else None
+        if not user_id:
+            domain.append(('sessionid', '=', sessionid))
+        return domain
 
     @classmethod
     def create_cart(cls, user=None):
@@ -192,22 +1308,26 @@ class Cart(ModelSQL):
         return cls.create([values])[0]
 
     @classmethod
-    @context_processor('get_cart')
-    def open_cart(cls, create_order=False):
+    def open_cart(cls, create_order=False, buffer_changes=False):
         """Logic of this cart functionality is inspired by amazon. Most
         e-commerce systems handle cart in a different way and it is important
         to know how the cart behaves under different circumstances.
 
         :param create_order: If `True` Create a sale order and attach
             if one does not already exist.
+        :param buffer_changes: If `True` the buffered changes of the cart
+            are not written to its sale, see :meth:`buffer_change`.
         :return: The Active record for the shopping cart of the user
 
         The method is guaranteed to return a cart but the cart may not have
         a sale order. For methods like add to cart which definitely need a sale
         order pass :attr: create_order = True so that an order is also assured.
+        The staged lines and the buffered changes of the cart are then written
+        to the sale, unless `buffer_changes` is set, like when more changes
+        are buffered.
         """
-        Sale = Pool().get('sale.sale')
         NereidUser = Pool().get('nereid.user')
+        LatestCartSale = Pool().get('sale.sale.latest_cart')
 
         # request.nereid_user is not used here this method is used by the
         # signal handlers immediately after a user logs in (but before being
@@ -229,23 +1349,27 @@ class Cart(ModelSQL):
 
         # Check if the order needs to be created
         if create_order and not cart.sale:
-            existing_sale_orders = None
+            existing_sale_order = None
             if user_id:
-                # Try any abandoned carts that may exist if user is registered
+                # Try the latest abandoned cart that may exist if user is
+                # registered
                 user = NereidUser(user_id)
-                existing_sale_orders = Sale.search([
-                    ('state', '=', 'draft'),
-                    ('is_cart', '=', True),
-                    ('website', '=', request.nereid_website.id),
-                    ('party', '=', user.party.id),
-                    ('currency', '=', request.nereid_currency.id)
-                ], limit=1)
-            if existing_sale_orders:
-                cart.sale = existing_sale_orders[0]
+                existing_sale_order = LatestCartSale.get_sale(
+                    request.nereid_website.id, user.party.id,
+                    request.nereid_currency.id
+                )
+            if existing_sale_order:
+                cart.sale = existing_sale_order
                 cart.save()
             else:
                 cart.create_draft_sale()
 
+        if create_order and not cart.user and cart.lines:
+            # The sale is needed now, like at checkout
+            cart.materialize_lines()
+        if create_order and not buffer_changes:
+            cart.flush_changes()
+
         return cls(cart.id)
 
     def sanitise_state(self, user_id):
@@ -272,15 +1396,21 @@ class Cart(ModelSQL):
         return self.save()
 
     def check_update_date(self):
-        """Check if the sale_date is same as today
-        If not then update the sale_date with today's date
+        """Check if the sale_date of the cart is older than today.
+
+        The sale date is not written here. Stale carts are moved to today
+        in bulk by :meth:`nereid.website.update_cart_sale_dates`, which is
+        run every night by the scheduler, so that the first cart interaction
+        of the day does not have to write to (and lock) the sale.
+
+        :return: True if the sale date is older than today
         """
         Date = Pool().get('ir.date')
-        Sale = Pool().get('sale.sale')
 
-        if self.sale and self.sale.sale_date \
-                and self.sale.sale_date < Date.today():
-            Sale.write([self.sale], {'sale_date': Date.today()})
+        return bool(
+            self.sale and self.sale.sale_date
+            and self.sale.sale_date < Date.today()
+        )
 
     def create_draft_sale(self, user=None, party=None):
         """A helper for the cart which creates a draft order for the given
@@ -290,24 +1420,40 @@ class Cart(ModelSQL):
                      user of the cart. If the user is not mentioned in the cart
                      (guest cart), the user is guest user of the website.
         :param party: PArty who has to own the sale
+
+        Guest carts take a sale from the pool of guest cart sales created in
+        advance, see :meth:`nereid.website.fill_guest_sale_pools`, and one is
+        only created if the pool is empty.
         """
         Sale = Pool().get('sale.sale')
+        NereidUser = Pool().get('nereid.user')
+
+        config = request.nereid_website.get_cart_config()
+        if user is None and party is None and not self.user:
+            # Guest carts take a sale created in advance if there is one
+            sale = Sale.claim_pooled_cart_sale(
+                request.nereid_website.id, request.nereid_currency.id
+            )
+            if sale is not None:
+                self.sale = sale
+                self.save()
+                return
 
         if user is None:
-            user = self.user or request.nereid_website.guest_user
+            user = self.user or NereidUser(config.guest_user)
         if party is None:
             party = user.party
 
         sale_values = {
             'party': party.id,
             'currency': request.nereid_currency.id,
-            'company': request.nereid_website.company.id,
+            'company': config.company,
             'is_cart': True,
             'state': 'draft',
             'website': request.nereid_website.id,
             'nereid_user': user.id,
-            'warehouse': request.nereid_website.warehouse.id,
-            'payment_term': request.nereid_website.payment_term.id,
+            'warehouse': config.warehouse,
+            'payment_term': config.payment_term,
         }
         self.sale = Sale.create([sale_values])[0]
         self.save()
@@ -327,12 +1473,25 @@ class Cart(ModelSQL):
         Response:
             'OK' if X-HTTPRequest
             Redirect to shopping cart if normal request
+
+        For XHR requests with the `summary` argument set to 1, the response
+        also has the state of the changed cart, see
+        :meth:`_get_changed_cart_data`.
+
+        The products added to guest carts are staged, without creating a
+        sale, if the website stages guest carts. See :meth:`stages_lines`.
+        The changes of the other carts are buffered if the website buffers
+        cart changes, see :meth:`buffer_change`.
         """
         Product = Pool().get('product.product')
+        SaleLine = Pool().get('sale.line')
 
         form = AddtoCartForm()
         if form.validate_on_submit():
-            cart = cls.open_cart(create_order=True)
+            stage = cls.stages_lines()
+            cart = cls.open_cart(
+                create_order=not stage, buffer_changes=cls.buffers_changes()
+            )
             action = request.values.get('action', 'set')
             if form.quantity.data <= 0:
                 message = _(
@@ -349,25 +1508,50 @@ class Cart(ModelSQL):
                 flash(message)
                 return redirect(request.referrer)
 
-            sale_line = cart.sale._add_or_update(
-                form.product.data, form.quantity.data, action
-            )
+            if stage and not cart.sale:
+                # Validate that the product can still be bought
+                SaleLine(
+                    product=form.product.data
+                ).validate_for_product_inventory()
+                if cart.id is None:
+                    cart = cls.create_cart()
+                sale_line = cart.stage_line(
+                    form.product.data, form.quantity.data, action
+                )
+            elif cls.buffers_changes():
+                SaleLine(
+                    product=form.product.data
+                ).validate_for_product_inventory()
+                cart.buffer_change(
+                    form.product.data, form.quantity.data, action
+                )
+                sale_line = None
+            else:
+                sale_line = cart.sale._add_or_update(
+                    form.product.data, form.quantity.data, action
+                )
 
-            # Validate that product availability in inventory is not less than
-            # warehouse quantity
-            sale_line.validate_for_product_inventory()
+                # Validate that product availability in inventory is not less
+                # than warehouse quantity
+                sale_line.validate_for_product_inventory()
 
-            sale_line.save()
+                sale_line.save()
 
             if action == 'add':
                 message = _('The product has been added to your cart')
             else:
                 message = _('Your cart has been updated with the product')
             if request.is_xhr:
-                return jsonify(
-                    message=unicode(message),
-                    line=sale_line.serialize(purpose='cart')
-                ), 200
+                data = {
+                    'message': unicode(message),
+                    'line': sale_line.serialize(purpose='cart')
+                    if sale_line else cart.serialize_buffered_line(
+                        form.product.data
+                    ),
+                }
+                if request.values.get('summary', 0, type=int):
+                    data['cart'] = cls._get_changed_cart_data(cart)
+                return jsonify(data), 200
             flash(message, 'info')
 
         return redirect(url_for('nereid.cart.view_cart'))
@@ -381,31 +1565,143 @@ class Cart(ModelSQL):
             line_id : ID of the line
 
         Response: 'OK' if X-HTTPRequest else redirect to shopping cart
+
+        For XHR requests with the `summary` argument set to 1, the response
+        also has the state of the changed cart, see
+        :meth:`_get_changed_cart_data`.
         """
         SaleLine = Pool().get('sale.line')
+        CartLine = Pool().get('nereid.cart.line')
 
+        cls.flush_user_changes()
         cart = cls.open_cart()
-        if not cart.sale:
+        if cart.sale:
+            Line = SaleLine
+            domain = [('sale', '=', cart.sale.id)]
+        elif cart.id is not None:
+            # The lines of carts without a sale are staged
+            Line = CartLine
+            domain = [('cart', '=', cart.id)]
+        else:
             abort(404)
 
         try:
-            sale_line, = SaleLine.search([
-                ('id', '=', line),
-                ('sale', '=', cart.sale.id),
-            ])
+            sale_line, = Line.search([('id', '=', line)] + domain)
         except ValueError:
             message = 'Looks like the item is already deleted.'
         else:
-            SaleLine.delete([sale_line])
+            Line.delete([sale_line])
             message = 'The order item has been successfully removed.'
 
         flash(_(message))
 
         if request.is_xhr:
+            if request.values.get('summary', 0, type=int):
+                return jsonify(
+                    message=message, cart=cls._get_changed_cart_data(cart)
+                )
             return jsonify(message=message)
 
         return redirect(url_for('nereid.cart.view_cart'))
 
+    @classmethod
+    @route('/cart/update', methods=['POST', 'PATCH'])
+    def update_cart(cls):
+        """
+        Change the quantities of and delete several lines of the cart at once.
+        Either all the changes are done or none.
+
+        The changes are given either as a JSON object:
+
+            quantities  : object mapping line IDs to their new quantity
+            delete      : list of the IDs of the lines to delete
+
+        or as form data, where each `quantity-<line ID>` field is the new
+        quantity of a line and each `delete` field the ID of a line to
+        delete.
+
+        Response: The message and the state of the changed cart (see
+        :meth:`_get_changed_cart_data`) if X-HTTPRequest else redirect to
+        shopping cart
+        """
+        SaleLine = Pool().get('sale.line')
+
+        cls.flush_user_changes()
+        cart = cls.open_cart()
+        if not cart.sale:
+            abort(404)
+
+        data = request.get_json(silent=True)
+        try:
+            if data is not None:
+                quantities = dict(
+                    (int(line_id), float(quantity))
+                    for line_id, quantity in
+                    (data.get('quantities') or {}).iteritems()
+                )
+                delete = set(map(int, data.get('delete') or []))
+            else:
+                quantities = dict(
+                    (int(key.split('-', 1)[1]), float(quantity))
+                    for key, quantity in request.form.iteritems()
+                    if key.startswith('quantity-')
+                )
+                delete = set(map(int, request.form.getlist('delete')))
+        except (ValueError, TypeError, AttributeError):
+            abort(400)
+        # float() and JSON accept 'nan' and 'inf'
+        if any(
+                math.isinf(quantity) or math.isnan(quantity)
+                for quantity in quantities.itervalues()):
+            abort(400)
+
+        lines = dict(
+            (line.id, line) for line in SaleLine.search([
+                ('id', 'in', list(set(quantities) | delete)),
+                ('sale', '=', cart.sale.id),
+                ('type', '=', 'line'),
+            ])
+        )
+
+        message = None
+        if any(quantity <= 0 for quantity in quantities.itervalues()):
+            message = _(
+                'Be sensible! You can only add real quantities to cart')
+        elif set(quantities) - set(lines):
+            message = _('Looks like some of the items are not in your cart.')
+        if message is not None:
+            if request.is_xhr:
+                return jsonify(message=unicode(message)), 400
+            flash(message)
+            return redirect(url_for('nereid.cart.view_cart'))
+
+        quantities = dict(
+            (lines[line_id], quantity)
+            for line_id, quantity in quantities.iteritems()
+            if line_id not in delete
+        )
+        if cart.sale.validate_cart_inventory(lines=list(quantities)):
+            message = _('This product is no longer available')
+            if request.is_xhr:
+                return jsonify(message=unicode(message)), 400
+            flash(message)
+            return redirect(url_for('nereid.cart.view_cart'))
+
+        # Lines already deleted are ignored
+        cart.sale.update_cart_lines(
+            quantities=quantities,
+            delete=[lines[line_id] for line_id in delete if line_id in lines],
+        )
+
+        message = _('Your cart has been updated')
+        if request.is_xhr:
+            return jsonify(
+                message=unicode(message),
+                cart=cls._get_changed_cart_data(cart),
+            )
+        flash(message, 'info')
+        return redirect(url_for('nereid.cart.view_cart'))
+
     @staticmethod
     @user_logged_in.connect
     def login_event_handler(sender, user):
@@ -445,6 +1741,7 @@ class Cart(ModelSQL):
 
         if not guest_cart:
             return
+        guest_cart.flush_changes()
 
         # There is a cart
         if guest_cart.sale and guest_cart.sale.lines:
@@ -453,6 +1750,136 @@ class Cart(ModelSQL):
             for from_line in guest_cart.sale.lines:
                 sale_line = from_line.add_to(to_cart.sale)
                 sale_line.save()
+        elif guest_cart.lines:
+            to_cart = cls.open_cart(True)
+            guest_cart.materialize_lines(to_cart.sale)
 
         # Clear and delete the old cart
         guest_cart._clear_cart()
+
+
+class CartLine(ModelSQL):
+    """
+    A product added to a guest cart which has no sale yet, see
+    :meth:`Cart.stages_lines`.
+    """
+    __name__ = 'nereid.cart.line'
+
+    cart = fields.Many2One(
+        'nereid.cart', 'Cart', required=True, select=True, ondelete='CASCADE'
+    )
+    product = fields.Many2One(
+        'product.product', 'Product', required=True, ondelete='CASCADE'
+    )
+    quantity = fields.Float('Quantity', required=True)
+    unit = fields.Many2One('product.uom', 'Unit', required=True)
+    #: Unit price when the product was added, as the sale price is only
+    #: computed again when the line is moved to a sale
+    unit_price = fields.Numeric('Unit Price', digits=(16, 4))
+    #: Currency of the unit price
+    currency = fields.Many2One('currency.currency', 'Currency', required=True)
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(CartLine, cls).create(vlist)
+        Pool().get('nereid.cart').bump_revision(
+            carts=[line.cart for line in lines]
+        )
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        super(CartLine, cls).write(*args)
+        Pool().get('nereid.cart').bump_revision(
+            carts=[line.cart for line in sum(args[::2], [])]
+        )
+
+    @classmethod
+    def delete(cls, lines):
+        carts = [line.cart.id for line in lines]
+        super(CartLine, cls).delete(lines)
+        Pool().get('nereid.cart').bump_revision(carts=carts)
+
+    @property
+    def amount(self):
+        "Quantity times the unit price, rounded in the currency of the line"
+        return self.currency.round(
+            Decimal(str(self.quantity)) * (self.unit_price or Decimal('0'))
+        )
+
+    def serialize(self, purpose=None):
+        """Serialize the staged line like the sale lines of the cart, see
+        :meth:`sale.line.serialize_cart_lines`
+        """
+        if purpose != 'cart':
+            return {}
+
+        currency_format = get_currency_format(
+            self.currency.code, request.nereid_language.code
+        )
+        number_format = get_number_format(request.nereid_language.code)
+        serialized_product = self.product.serialize(purpose='cart')
+        return {
+            'id': self.id,
+            'display_name': self.product.name,
+            'url': self.product.get_absolute_url(_external=True),
+            'image': serialized_product['image'],
+            'product': serialized_product,
+            'quantity': number_format(self.quantity),
+            'unit': self.unit.symbol,
+            'unit_price': currency_format(self.unit_price or 0),
+            'amount': currency_format(self.amount),
+            'remove_url': url_for(
+                'nereid.cart.delete_from_cart', line=self.id
+            ),
+        }
+
+
+class CartChange(ModelSQL):
+    """
+    A change of the quantity of a product in a cart, buffered until it is
+    written to the sale of the cart, see :meth:`Cart.buffer_change`.
+    """
+    __name__ = 'nereid.cart.change'
+
+    cart = fields.Many2One(
+        'nereid.cart', 'Cart', required=True, select=True, ondelete='CASCADE'
+    )
+    product = fields.Many2One(
+        'product.product', 'Product', required=True, ondelete='CASCADE'
+    )
+    quantity = fields.Float('Quantity', required=True)
+    action = fields.Selection([
+        ('set', 'Set'),
+        ('add', 'Add'),
+    ], 'Action', required=True)
+
+
+class CartArchive(ModelSQL):
+    """
+    Carts which are no longer used, moved out of the cart table by
+    :meth:`Cart.archive_retired_carts` and kept for analytics.
+    """
+    __name__ = 'nereid.cart.archive'
+
+    #: ID of the cart in the cart table
+    cart = fields.Integer('Cart ID', readonly=True, select=True)
+    user = fields.Many2One(
+        'nereid.user', 'Cart owner', readonly=True, select=True
+    )
+    sessionid = fields.Char('Session ID', readonly=True)
+    website = fields.Many2One('nereid.website', 'Website', readonly=True)
+    sale = fields.Many2One(
+        'sale.sale', 'Sale Order', readonly=True, select=True,
+        ondelete='SET NULL'
+    )
+    revision = fields.Integer('Revision', readonly=True)
+    cart_create_date = fields.Timestamp('Cart Create Date', readonly=True)
+    cart_write_date = fields.Timestamp('Cart Write Date', readonly=True)
+
+
+@transaction_stop.connect
+def _forget_request_carts(sender):
+    """Forget the carts shared while handling the request once its
+    transaction is over, as it may be retried after a rollback"""
+    g.request_carts = {}
@@ -6,7 +6,7 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 
 __metaclass__ = PoolMeta
 
@@ -28,3 +28,15 @@ class SaleChannel:
         sources.append(('webshop', 'Webshop'))
 
         return sources
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('nereid.website')._cart_config_cache.clear()
+        super(SaleChannel, cls).write(*args)
+        Pool().get('sale.sale').clear_default_price_list_cache()
+
+    @classmethod
+    def delete(cls, channels):
+        Pool().get('nereid.website')._cart_config_cache.clear()
+        super(SaleChannel, cls).delete(channels)
+        Pool().get('sale.sale').clear_default_price_list_cache()
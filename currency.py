@@ -0,0 +1,48 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.currency
+
+    Clear the stored amounts of the open carts when the rates of their
+    currency change
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['CurrencyRate']
+__metaclass__ = PoolMeta
+
+
+class CurrencyRate:
+    "Currency Rate"
+    __name__ = 'currency.currency.rate'
+
+    @classmethod
+    def create(cls, vlist):
+        rates = super(CurrencyRate, cls).create(vlist)
+        cls._update_open_carts(rates)
+        return rates
+
+    @classmethod
+    def write(cls, *args):
+        super(CurrencyRate, cls).write(*args)
+        cls._update_open_carts(sum(args[::2], []))
+
+    @classmethod
+    def delete(cls, rates):
+        currencies = list(set(rate.currency.id for rate in rates))
+        super(CurrencyRate, cls).delete(rates)
+        Pool().get('sale.sale').update_open_carts(currencies=currencies)
+
+    @classmethod
+    def _update_open_carts(cls, rates):
+        '''
+        Clear the stored amounts of the open carts in the currencies of the
+        given rates
+
+        :param rates: List of currency rate active records
+        '''
+        Pool().get('sale.sale').update_open_carts(
+            currencies=list(set(rate.currency.id for rate in rates))
+        )
@@ -0,0 +1,55 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.formatters
+
+    Locale based formatters used to render the cart
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from functools import partial
+
+from babel import Locale, numbers
+
+__all__ = ['get_currency_format', 'get_number_format']
+
+#: Formatters built so far in the process, keyed by (currency code,
+#: language code) for currencies and by language code for numbers
+_currency_formats = {}
+_number_formats = {}
+
+
+def get_currency_format(currency_code, language_code):
+    """
+    Return a function which formats an amount in the given currency for the
+    given language, like :func:`babel.numbers.format_currency`.
+
+    The locale is parsed only once per process and the formatter is reused
+    for every amount formatted afterwards.
+
+    :param currency_code: ISO code of the currency
+    :param language_code: Code of the language, eg: en_US
+    """
+    key = (currency_code, language_code)
+    try:
+        return _currency_formats[key]
+    except KeyError:
+        return _currency_formats.setdefault(key, partial(
+            numbers.format_currency, currency=currency_code,
+            locale=Locale.parse(language_code)
+        ))
+
+
+def get_number_format(language_code):
+    """
+    Return a function which formats a number for the given language, like
+    :func:`babel.numbers.format_number`.
+
+    :param language_code: Code of the language, eg: en_US
+    """
+    try:
+        return _number_formats[language_code]
+    except KeyError:
+        return _number_formats.setdefault(language_code, partial(
+            numbers.format_number, locale=Locale.parse(language_code)
+        ))
@@ -0,0 +1,30 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.party
+
+    Clear the cached default price lists when the price list of a party
+    changes
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Party']
+__metaclass__ = PoolMeta
+
+
+class Party:
+    "Party"
+    __name__ = 'party.party'
+
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+        if any('sale_price_list' in values for values in args[1::2]):
+            Pool().get('sale.sale').clear_default_price_list_cache()
+
+    @classmethod
+    def delete(cls, parties):
+        super(Party, cls).delete(parties)
+        Pool().get('sale.sale').clear_default_price_list_cache()
@@ -0,0 +1,56 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.price_list
+
+    Mark the open carts to reprice when a price list changes
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['PriceList', 'PriceListLine']
+__metaclass__ = PoolMeta
+
+
+class PriceList:
+    "Price List"
+    __name__ = 'product.price_list'
+
+    @classmethod
+    def write(cls, *args):
+        super(PriceList, cls).write(*args)
+        Pool().get('sale.sale').mark_carts_to_reprice(
+            price_lists=map(int, sum(args[::2], []))
+        )
+
+
+class PriceListLine:
+    "Price List Line"
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(PriceListLine, cls).create(vlist)
+        Pool().get('sale.sale').mark_carts_to_reprice(
+            price_lists=list(set(line.price_list.id for line in lines))
+        )
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        lines = sum(args[::2], [])
+        price_lists = set(line.price_list.id for line in lines)
+        super(PriceListLine, cls).write(*args)
+        price_lists.update(
+            line.price_list.id for line in cls.browse(map(int, lines))
+        )
+        Pool().get('sale.sale').mark_carts_to_reprice(
+            price_lists=list(price_lists)
+        )
+
+    @classmethod
+    def delete(cls, lines):
+        price_lists = list(set(line.price_list.id for line in lines))
+        super(PriceListLine, cls).delete(lines)
+        Pool().get('sale.sale').mark_carts_to_reprice(price_lists=price_lists)
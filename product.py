@@ -17,7 +17,9 @@ from trytond.pyson import Bool, Eval
 from nereid import request, cache, jsonify, abort, current_user, route
 from nereid.helpers import key_from_list
 
-__all__ = ['Product']
+from .purge import product_key, location_key, set_surrogate_keys
+
+__all__ = ['Product', 'Template']
 __metaclass__ = PoolMeta
 
 
@@ -105,12 +107,17 @@ class Product:
         """
         return self.template.default_uom.digits or 2
 
-    def can_buy_from_eshop(self):
+    def can_buy_from_eshop(self, quantity=None):
         """
         This function is used for inventory checking purpose. It returns a
         boolean result on the basis of fields such as min_warehouse_quantity.
+
+        :param quantity: The available quantity of the product if it was
+                         already computed, for example by
+                         :meth:`get_available_quantities`
         """
-        quantity = self.get_availability().get('quantity')
+        if quantity is None:
+            quantity = self.get_availability().get('quantity')
 
         if self.type != 'goods':
             # If product type is not goods, then inventory need not be checked
@@ -196,15 +203,15 @@ class Product:
         price_list = Sale.default_price_list()
 
         if current_user.is_anonymous():
-            customer = request.nereid_website.guest_user.party
+            customer_id = request.nereid_website.get_cart_config().guest_party
         else:
-            customer = current_user.party
+            customer_id = current_user.party.id
 
         # Build a Cache key to store in cache
         cache_key = key_from_list([
             Transaction().cursor.dbname,
             Transaction().user,
-            customer.id,
+            customer_id,
             price_list, self.id, quantity,
             request.nereid_currency.id,
             'product.product.sale_price',
@@ -213,7 +220,7 @@ class Product:
         if price is None:
             # There is a valid pricelist, now get the price
             with Transaction().set_context(
-                customer=customer.id,
+                customer=customer_id,
                 price_list=price_list,
                 currency=request.nereid_currency.id
             ):
@@ -238,11 +245,7 @@ class Product:
 
         :return: A dictionary with `quantity` and `forecast_quantity`
         """
-        context = {
-            'locations': [request.nereid_website.stock_location.id],
-            'stock_date_end': date.today() + relativedelta(days=7)
-        }
-        with Transaction().set_context(**context):
+        with Transaction().set_context(**self._get_availability_context()):
             return {
                 'quantity': self.get_quantity([self], 'quantity')[self.id],
                 'forecast_quantity': self.get_quantity(
@@ -250,6 +253,35 @@ class Product:
                 )[self.id],
             }
 
+    @staticmethod
+    def _get_availability_context():
+        """
+        Return the context in which the stock quantities of the products are
+        computed for the website.
+        """
+        return {
+            'locations': [
+                request.nereid_website.get_cart_config().stock_location
+            ],
+            'stock_date_end': date.today() + relativedelta(days=7)
+        }
+
+    @classmethod
+    def get_available_quantities(cls, products):
+        """
+        Return the available quantity of all the given products with a single
+        stock computation, as a dictionary of product ID and quantity.
+
+        If :meth:`get_availability` is subclassed to change how the quantity
+        is computed, this method should be changed too.
+
+        :param products: List of product active records
+        """
+        if not products:
+            return {}
+        with Transaction().set_context(**cls._get_availability_context()):
+            return cls.get_quantity(products, 'quantity')
+
     @classmethod
     @route('/product-availability/<uri>')
     def availability(cls, uri):
@@ -281,4 +313,34 @@ class Product:
         except ValueError:
             return abort(404)
 
-        return jsonify(product.get_availability())
+        response = jsonify(product.get_availability())
+        set_surrogate_keys(response, [
+            product_key(product.id),
+            location_key(
+                request.nereid_website.get_cart_config().stock_location
+            ),
+        ])
+        return response
+
+
+class Template:
+    "Product Template"
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        Product = Pool().get('product.product')
+
+        templates = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'list_price' in values:
+                templates.extend(records)
+        super(Template, cls).write(*args)
+        if templates:
+            # The prices of the carts with these products depend on it
+            Pool().get('sale.sale').mark_carts_to_reprice(
+                products=map(int, Product.search([
+                    ('template', 'in', map(int, templates)),
+                ]))
+            )
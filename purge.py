@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.purge
+
+    Surrogate keys of the responses which can be cached by a caching proxy,
+    and purge of the keys when the data they show changes.
+
+    The purge requests are sent to the URL set in the `purge_url` option of
+    the `nereid_cart` section of the trytond configuration, with the keys in
+    the `Surrogate-Key` header. The HTTP method is `PURGE` unless set with
+    the `purge_method` option. Nothing is sent if no URL is set.
+
+    The tagged responses are kept by the proxy for the number of seconds
+    set in the `surrogate_ttl` option, a day by default. Only the responses
+    which are the same for every visitor, like the availability of a
+    product, are tagged. The cart responses belong to a session and are
+    never stored by the proxy.
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+import logging
+import urllib2
+
+from trytond.config import config
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = [
+    'product_key', 'location_key', 'set_surrogate_keys',
+    'purge_enabled', 'purge', 'PurgeQueue',
+]
+
+logger = logging.getLogger(__name__)
+
+
+def product_key(product_id):
+    "Returns the surrogate key of the responses showing the given product"
+    return 'product-%d' % product_id
+
+
+def location_key(location_id):
+    """Returns the surrogate key of the responses showing the stock of the
+    given location"""
+    return 'location-%d' % location_id
+
+
+def set_surrogate_keys(response, keys):
+    """
+    Tag the response with the given surrogate keys. If the responses are
+    purged, the proxy is also allowed to keep the response until it is
+    purged, for at most the `surrogate_ttl` option.
+
+    The response must be the same for every visitor, as it is then shared
+    by all of them.
+
+    :param response: The response object or lazy renderer
+    :param keys: List of surrogate keys
+    """
+    response.headers['Surrogate-Key'] = ' '.join(sorted(set(keys)))
+    if purge_enabled():
+        response.headers['Surrogate-Control'] = 'max-age=%d' % config.getint(
+            'nereid_cart', 'surrogate_ttl', 24 * 60 * 60
+        )
+
+
+def purge_enabled():
+    "Returns True if a purge URL is set in the configuration"
+    return bool(config.get('nereid_cart', 'purge_url'))
+
+
+def purge(keys):
+    """
+    Purge the responses tagged with any of the given surrogate keys.
+
+    The keys are queued in :class:`PurgeQueue` with the transaction and sent
+    by the scheduler once committed, so that the proxy does not fetch the
+    old data again before it is committed and neither the request nor the
+    transaction waits for the proxy. They are dropped if the transaction is
+    rolled back.
+
+    :param keys: List of surrogate keys
+    """
+    keys = set(keys)
+    if not keys or not purge_enabled():
+        return
+
+    if Transaction().cursor is not None:
+        Pool().get('nereid.purge.queue').create([
+            {'key': key} for key in keys
+        ])
+    else:
+        send_purge(keys)
+
+
+def send_purge(keys):
+    """
+    Send a purge request for the given surrogate keys
+
+    :param keys: List of surrogate keys
+    :return: True if the request was sent
+    """
+    request = urllib2.Request(
+        config.get('nereid_cart', 'purge_url'),
+        headers={'Surrogate-Key': ' '.join(sorted(keys))}
+    )
+    method = config.get('nereid_cart', 'purge_method', 'PURGE')
+    request.get_method = lambda: method
+    try:
+        urllib2.urlopen(request, timeout=5).close()
+    except (urllib2.URLError, IOError):
+        logger.warning(
+            'Could not purge surrogate keys: %s', keys, exc_info=True
+        )
+        return False
+    return True
+
+
+class PurgeQueue(ModelSQL):
+    """
+    Surrogate keys purged by a transaction, sent by the scheduler once it is
+    committed, see :func:`purge`.
+    """
+    __name__ = 'nereid.purge.queue'
+
+    key = fields.Char('Surrogate Key', required=True)
+
+    @classmethod
+    def send_queued(cls):
+        """
+        Send the queued keys with a single purge request. Called by the
+        scheduler. The keys are kept to be sent again if the request fails.
+        """
+        queued = cls.search([])
+        if not queued:
+            return
+        if send_purge(set(entry.key for entry in queued)):
+            cls.delete(queued)
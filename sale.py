@@ -7,27 +7,44 @@
     :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) Ltd.
     :license: GPLv3, see LICENSE for more details
 '''
-from functools import partial
-from babel import numbers
+import logging
+from collections import defaultdict
 from decimal import Decimal
 
+from sql import Literal, Null, For
+from sql.aggregate import Count, Max, Sum
+from sql.functions import Now
+from trytond import backend
 from trytond.pool import Pool, PoolMeta
-from trytond.model import fields
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.tools import reduce_ids
 from trytond.transaction import Transaction
+from trytond.cache import Cache
 from nereid import current_user, url_for, request, redirect, flash, abort
 from nereid.contrib.locale import make_lazy_gettext
 from nereid.ctx import has_request_context
+from flask import g
+
+from .formatters import get_currency_format, get_number_format
+from .tools import clean_transaction_cache
 _ = make_lazy_gettext('nereid_cart_b2c')
 
-__all__ = ['Sale', 'SaleLine']
+__all__ = ['Sale', 'SaleLine', 'LatestCartSale']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+#: Whether the PostgreSQL server of each database can skip locked rows
+_skip_locked = {}
+
 
 class Sale:
     '''Add a boolean to indicate if the order originated from a shopping cart.
     '''
     __name__ = 'sale.sale'
 
+    _default_price_list_cache = Cache('sale.sale.default_price_list')
+
     is_cart = fields.Boolean(
         'Is Cart Order?', readonly=True, select=True
     )
@@ -38,6 +55,173 @@ class Sale:
         'nereid.user', 'Nereid User', select=True
     )
 
+    #: Draft guest cart sales created in advance, which are not attached to
+    #: a cart yet. See :meth:`claim_pooled_cart_sale`.
+    cart_pool = fields.Boolean('In Cart Pool', readonly=True)
+
+    #: Open carts whose prices may have changed since they were priced,
+    #: see :meth:`mark_carts_to_reprice`.
+    cart_to_reprice = fields.Boolean('Cart To Reprice', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+
+        # The lookup of abandoned carts by :meth:`nereid.cart.open_cart`
+        table.index_action(
+            ['party', 'website', 'currency', 'state', 'is_cart'], 'add'
+        )
+        # The claim of pooled sales by :meth:`claim_pooled_cart_sale`
+        table.index_action(['cart_pool', 'website', 'currency'], 'add')
+
+    @staticmethod
+    def default_cart_pool():
+        return False
+
+    @staticmethod
+    def default_cart_to_reprice():
+        return False
+
+    @classmethod
+    def claim_pooled_cart_sale(cls, website_id, currency_id):
+        """
+        Take a draft guest cart sale of the website in the currency out of
+        the pool of sales created in advance by
+        :meth:`nereid.website.fill_guest_sale_pools`, so that the first
+        product added to a guest cart does not have to create the sale.
+
+        On PostgreSQL 9.5 and later the sale is locked when it is selected
+        and the sales locked by concurrent claims are skipped, so that
+        concurrent requests claim different sales instead of waiting for
+        each other. The update only succeeds if the sale is still in the
+        pool.
+
+        A sale claimed by a transaction committed after this one started
+        still fails to serialize on PostgreSQL. The claim is then undone,
+        within a savepoint which is only used there, and None is returned
+        so that a new sale is created instead of failing the request.
+
+        The pooled sale may have been created before the configuration of
+        the website or of its channel changed, so the update also sets the
+        fields a new guest cart sale would get from the configuration, and
+        the date of today.
+
+        :param website_id: ID of the website
+        :param currency_id: ID of the currency
+        :return: Active record of the claimed sale or None if the pool is
+                 empty
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        cursor = Transaction().cursor
+
+        if backend.name() != 'postgresql':
+            return cls._claim_pooled_cart_sale(website_id, currency_id)
+
+        cursor.execute('SAVEPOINT claim_pooled_cart_sale')
+        try:
+            sale = cls._claim_pooled_cart_sale(
+                website_id, currency_id, skip_locked=cls._skips_locked_rows()
+            )
+        except DatabaseOperationalError:
+            cursor.execute('ROLLBACK TO SAVEPOINT claim_pooled_cart_sale')
+            logger.info(
+                'Pooled cart sale of website %d claimed concurrently',
+                website_id
+            )
+            return None
+        cursor.execute('RELEASE SAVEPOINT claim_pooled_cart_sale')
+        return sale
+
+    @staticmethod
+    def _skips_locked_rows():
+        """
+        Returns True if the PostgreSQL server can skip locked rows, which
+        needs version 9.5 or later.
+        """
+        cursor = Transaction().cursor
+        if cursor.database_name not in _skip_locked:
+            cursor.execute('SHOW server_version_num')
+            _skip_locked[cursor.database_name] = \
+                int(cursor.fetchone()[0]) >= 90500
+        return _skip_locked[cursor.database_name]
+
+    @classmethod
+    def _claim_pooled_cart_sale(
+            cls, website_id, currency_id, skip_locked=False):
+        """
+        Take a sale out of the pool, see :meth:`claim_pooled_cart_sale`.
+
+        :param website_id: ID of the website
+        :param currency_id: ID of the currency
+        :param skip_locked: If True the sale is locked when it is selected
+                            and the locked sales are skipped
+        :return: Active record of the claimed sale or None
+        """
+        Website = Pool().get('nereid.website')
+        Date = Pool().get('ir.date')
+
+        sale = cls.__table__()
+        cursor = Transaction().cursor
+
+        query, params = sale.select(
+            sale.id,
+            where=(
+                (sale.cart_pool == Literal(True))
+                & (sale.website == website_id)
+                & (sale.currency == currency_id)
+                & (sale.state == 'draft')
+            ),
+            order_by=sale.id.asc, limit=1
+        )
+        if skip_locked:
+            # python-sql has no SKIP LOCKED
+            query += ' FOR UPDATE SKIP LOCKED'
+        cursor.execute(query, params)
+        row = cursor.fetchone()
+        if not row:
+            return None
+        sale_id, = row
+
+        config = Website(website_id).get_cart_config()
+        cursor.execute(*sale.update(
+            columns=[
+                sale.cart_pool, sale.party, sale.nereid_user, sale.company,
+                sale.warehouse, sale.payment_term, sale.price_list,
+                sale.sale_date, sale.write_uid, sale.write_date,
+            ],
+            values=[
+                Literal(False), config.guest_party, config.guest_user,
+                config.company, config.warehouse, config.payment_term,
+                cls._get_default_price_list(None), Date.today(),
+                Transaction().user, Now(),
+            ],
+            where=(sale.id == sale_id) & (sale.cart_pool == Literal(True))
+        ))
+        if cursor.rowcount != 1:
+            return None
+
+        clean_transaction_cache(cls.__name__, [sale_id])
+        return cls(sale_id)
+
+    @staticmethod
+    def _get_abandoned_cart_domain(website_id, party_id, currency_id):
+        """
+        Return the domain of the draft cart sales of the party which
+        :meth:`nereid.cart.open_cart` can attach to a new cart. It is matched
+        by the index on party, website, currency, state and is_cart.
+        """
+        return [
+            ('state', '=', 'draft'),
+            ('is_cart', '=', True),
+            ('website', '=', website_id),
+            ('party', '=', party_id),
+            ('currency', '=', currency_id),
+        ]
+
     @staticmethod
     def default_is_cart():
         """Dont make this as a default as this would cause orders being placed
@@ -45,34 +229,417 @@ class Sale:
         """
         return False
 
-    @staticmethod
-    def default_price_list():
+    @classmethod
+    def default_price_list(cls):
         """Get the pricelist of active user. In the
         event that the logged in user does not have a pricelist set against
         the user, the channel's pricelist is chosen.
 
-        :param user: active record of the nereid user
+        The price list is computed once per party (and user and context of
+        the transaction) and then kept in a cache shared by the processes,
+        which is cleared when a party, a channel or the current channel of
+        a user changes. Within a request it is also kept for the next calls,
+        as it is called for every product displayed.
         """
+        party_id = None
+        if has_request_context() and not current_user.is_anonymous():
+            party_id = current_user.party.id
+
+        if has_request_context():
+            if not hasattr(g, 'default_price_lists'):
+                g.default_price_lists = {}
+            price_lists = g.default_price_lists
+            key = (Transaction().user, party_id)
+            if key not in price_lists:
+                price_lists[key] = cls._get_default_price_list(party_id)
+            return price_lists[key]
+        return cls._get_default_price_list(party_id)
+
+    @classmethod
+    def _get_default_price_list(cls, party_id):
+        """Return the ID of the price list of the party, if any, else of the
+        current channel of the user
+
+        :param party_id: ID of the party of the nereid user or None
+        """
+        price_list = cls._default_price_list_cache.get(party_id, -1)
+        if price_list != -1:
+            return price_list
+
         User = Pool().get('res.user')
+        Party = Pool().get('party.party')
+
         user = User(Transaction().user)
-        channel_price_list = user.current_channel.price_list.id if \
-            user.current_channel else None
+        price_list = user.current_channel.price_list.id if \
+            user.current_channel and user.current_channel.price_list \
+            else None
+
+        # Personalise the pricelist of the user logged in. Sorry anonymous
+        # users, you get the shop price
+        if party_id is not None and Party(party_id).sale_price_list:
+            # There is a sale pricelist for the specific user's party.
+            price_list = Party(party_id).sale_price_list.id
+
+        cls._default_price_list_cache.set(party_id, price_list)
+        return price_list
 
-        if not has_request_context():
-            # Not a nereid request
-            return channel_price_list
+    @classmethod
+    def clear_default_price_list_cache(cls):
+        """Clear the price lists cached by :meth:`default_price_list`.
+        Called when a party, a channel or a user changes.
+        """
+        cls._default_price_list_cache.clear()
+        if has_request_context():
+            g.default_price_lists = {}
 
-        # If control reaches here, then this is a nereid request. Lets try
-        # and personalise the pricelist of the user logged in.
-        if current_user.is_anonymous():
-            # Sorry anonymous users, you get the shop price
-            return channel_price_list
+    @classmethod
+    def create(cls, vlist):
+        LatestCartSale = Pool().get('sale.sale.latest_cart')
 
-        if current_user.party.sale_price_list:
-            # There is a sale pricelist for the specific user's party.
-            return current_user.party.sale_price_list.id
+        sales = super(Sale, cls).create(vlist)
+        LatestCartSale.set_latest(sales)
+        return sales
+
+    @classmethod
+    def write(cls, *args):
+        Cart = Pool().get('nereid.cart')
+        LatestCartSale = Pool().get('sale.sale.latest_cart')
+
+        # A cart shows a different sale once it is no more a valid draft of
+        # the party in the currency of the cart
+        actions = iter(args)
+        sales, dated_sales = [], []
+        for records, values in zip(actions, actions):
+            if set(values) & set(LatestCartSale.sale_fields):
+                sales.extend(records)
+            # The taxes are computed at the sale date
+            if 'sale_date' in values:
+                dated_sales.extend(records)
+        keys = LatestCartSale.get_keys(cls.browse(map(int, sales)))
+
+        super(Sale, cls).write(*args)
+
+        if sales:
+            keys |= LatestCartSale.get_keys(cls.browse(map(int, sales)))
+            LatestCartSale.update_latest(keys)
+        cls.clear_cart_cache(dated_sales)
+        Cart.bump_revision(sales=sales + dated_sales)
+
+    @classmethod
+    def delete(cls, sales):
+        LatestCartSale = Pool().get('sale.sale.latest_cart')
+
+        keys = LatestCartSale.get_keys(sales)
+        super(Sale, cls).delete(sales)
+        LatestCartSale.update_latest(keys)
+
+    @classmethod
+    @ModelView.button
+    def quote(cls, sales):
+        Cart = Pool().get('nereid.cart')
 
-        return channel_price_list
+        # The checkout must see the changes buffered by the carts
+        Cart.flush_sale_changes(sales)
+        super(Sale, cls).quote(sales)
+
+    @classmethod
+    def mark_carts_to_reprice(cls, price_lists=None, products=None):
+        '''
+        Mark the open carts using the given price lists or having lines of
+        the given products, so that :meth:`reprice_carts_from_cron` reprices
+        them. Called when price lists and list prices change.
+
+        The carts are marked by updates which price nothing.
+
+        :param price_lists: List of price list IDs
+        :param products: List of product IDs
+        '''
+        SaleLine = Pool().get('sale.line')
+
+        sale = cls.__table__()
+        line = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        conditions = []
+        if price_lists:
+            conditions.append(reduce_ids(sale.price_list, price_lists))
+        if products:
+            conditions.append(sale.id.in_(line.select(
+                line.sale, where=reduce_ids(line.product, products)
+            )))
+        for condition in conditions:
+            cursor.execute(*sale.update(
+                columns=[sale.cart_to_reprice],
+                values=[Literal(True)],
+                where=(sale.is_cart == Literal(True))
+                & (sale.state == 'draft')
+                & condition
+            ))
+        if conditions:
+            clean_transaction_cache(cls.__name__)
+
+    @classmethod
+    def reprice_carts(
+        cls, price_lists=None, parties=None, products=None, chunk_size=500,
+        start_id=0, commit=False, marked_only=False
+    ):
+        '''
+        Reprice the lines of open carts (draft sales created from a cart)
+        with the current prices.
+
+        The carts are processed in chunks ordered by their ID. Each chunk
+        is priced with :meth:`SaleLine.get_cart_unit_prices` and only the
+        lines whose price changed are written, grouped by their new price.
+        Since repricing an up to date cart writes nothing, running the job
+        again after an interruption only costs the reads of the carts that
+        were already done. The ID returned can also be passed back as
+        `start_id` to resume right after the last processed chunk.
+
+        The price a changed line had before is kept, so that the shopper is
+        told about the change when the cart is viewed next, see
+        :meth:`notify_price_changes`.
+
+        :param price_lists: Only reprice carts using these price list IDs
+        :param parties: Only reprice carts of these party IDs
+        :param products: Only reprice carts having lines of these product IDs
+        :param chunk_size: Number of carts processed per chunk
+        :param start_id: Only carts with an ID greater than this are repriced
+        :param commit: If True the transaction is committed after each chunk
+        :param marked_only: Only reprice the carts marked by
+                            :meth:`mark_carts_to_reprice`
+        :return: ID of the last sale processed
+        '''
+        SaleLine = Pool().get('sale.line')
+
+        sale_table = cls.__table__()
+        cursor = Transaction().cursor
+
+        domain = [
+            ('is_cart', '=', True),
+            ('state', '=', 'draft'),
+        ]
+        if marked_only:
+            domain.append(('cart_to_reprice', '=', True))
+        if price_lists is not None:
+            domain.append(('price_list', 'in', price_lists))
+        if parties is not None:
+            domain.append(('party', 'in', parties))
+        if products is not None:
+            domain.append(('lines.product', 'in', products))
+
+        total = cls.search(domain + [('id', '>', start_id)], count=True)
+        done, last_id = 0, start_id
+        while True:
+            sales = cls.search(
+                domain + [('id', '>', last_id)],
+                order=[('id', 'ASC')], limit=chunk_size
+            )
+            if not sales:
+                break
+
+            # The carts are up to date once the chunk is done
+            cursor.execute(*sale_table.update(
+                columns=[sale_table.cart_to_reprice],
+                values=[Literal(False)],
+                where=reduce_ids(sale_table.id, map(int, sales))
+                & (sale_table.cart_to_reprice == Literal(True))
+            ))
+            clean_transaction_cache(cls.__name__, map(int, sales))
+
+            lines = SaleLine.search([
+                ('sale', 'in', map(int, sales)),
+                ('type', '=', 'line'),
+            ])
+            prices = SaleLine.get_cart_unit_prices(lines)
+            lines_by_prices = defaultdict(list)
+            for line in lines:
+                if line.id in prices and prices[line.id] != line.unit_price:
+                    old_price = line.cart_old_unit_price or line.unit_price
+                    if old_price == prices[line.id]:
+                        # Back to the price the shopper has seen
+                        old_price = None
+                    lines_by_prices[(prices[line.id], old_price)].append(
+                        line
+                    )
+            if lines_by_prices:
+                args = []
+                for (price, old_price), price_lines in \
+                        lines_by_prices.iteritems():
+                    args.extend([price_lines, {
+                        'unit_price': price,
+                        'cart_old_unit_price': old_price,
+                    }])
+                SaleLine.write(*args)
+
+            last_id = sales[-1].id
+            done += len(sales)
+            logger.info(
+                'Repriced %d of %d carts (last sale ID: %d)',
+                done, total, last_id
+            )
+            if commit:
+                Transaction().cursor.commit()
+        return last_id
+
+    @classmethod
+    def reprice_carts_from_cron(cls):
+        '''
+        Reprice the open carts marked by :meth:`mark_carts_to_reprice`.
+        Called by the scheduler.
+        '''
+        return cls.reprice_carts(commit=True, marked_only=True)
+
+    @classmethod
+    def clear_cart_cache(cls, sales):
+        '''
+        Clear the amounts stored in the amount cache fields of the given
+        sales which are open carts, so that :meth:`get_cart_summary`
+        computes and stores them again the next time it is called.
+
+        This is called whenever the lines of a sale, the taxes of the lines,
+        the currency rates or the sale date are changed. It is a single
+        update which does not compute any amount, so changing a line
+        costs the same whatever the size of the cart. The amounts of draft
+        sales are always computed by Tryton itself, so the cache is only
+        used by the cart summary.
+
+        :param sales: List of sale active records or IDs
+        '''
+        sale = cls.__table__()
+        cursor = Transaction().cursor
+
+        sale_ids = map(int, sales)
+        if not sale_ids:
+            return
+        cursor.execute(*sale.update(
+            columns=[
+                sale.untaxed_amount_cache, sale.tax_amount_cache,
+                sale.total_amount_cache,
+            ],
+            values=[Null, Null, Null],
+            where=reduce_ids(sale.id, sale_ids)
+            & (sale.is_cart == Literal(True))
+            & (sale.state == 'draft')
+        ))
+        clean_transaction_cache(cls.__name__, sale_ids)
+
+    @classmethod
+    def update_open_carts(cls, taxes=None, currencies=None):
+        '''
+        Clear the stored amounts and bump the revision of the open carts
+        whose amounts depend on the given taxes or currencies, see
+        :meth:`clear_cart_cache`. Called when taxes and currency rates
+        change.
+
+        :param taxes: List of tax IDs used by the lines of the carts
+        :param currencies: List of currency IDs of the carts
+        '''
+        SaleLine = Pool().get('sale.line')
+        SaleLineTax = Pool().get('sale.line-account.tax')
+
+        sale = cls.__table__()
+        line = SaleLine.__table__()
+        line_tax = SaleLineTax.__table__()
+        cursor = Transaction().cursor
+
+        open_cart = (sale.is_cart == Literal(True)) & (sale.state == 'draft')
+        sale_ids = set()
+        if taxes:
+            cursor.execute(*line_tax.join(
+                line, condition=line_tax.line == line.id
+            ).join(
+                sale, condition=line.sale == sale.id
+            ).select(
+                sale.id,
+                where=reduce_ids(line_tax.tax, taxes) & open_cart,
+                group_by=sale.id
+            ))
+            sale_ids.update(row[0] for row in cursor.fetchall())
+        if currencies:
+            cursor.execute(*sale.select(
+                sale.id,
+                where=reduce_ids(sale.currency, currencies) & open_cart
+            ))
+            sale_ids.update(row[0] for row in cursor.fetchall())
+        if sale_ids:
+            SaleLine._update_carts(sales=sale_ids)
+
+    def store_cart_cache(self, untaxed_amount, tax_amount, total_amount):
+        '''
+        Store the amounts of the sale if it is an open cart, so that
+        :meth:`get_cart_summary` reads them until the lines change.
+
+        The amounts are written by a single update which does not change the
+        revision of the carts, and not at all within the readonly
+        transactions of GET requests.
+        '''
+        if has_request_context() and request.url_rule is not None \
+                and request.url_rule.is_readonly:
+            return
+
+        sale = self.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*sale.update(
+            columns=[
+                sale.untaxed_amount_cache, sale.tax_amount_cache,
+                sale.total_amount_cache,
+            ],
+            values=[untaxed_amount, tax_amount, total_amount],
+            where=(sale.id == self.id)
+            & (sale.is_cart == Literal(True))
+            & (sale.state == 'draft')
+        ))
+        clean_transaction_cache(self.__name__, [self.id])
+
+    def get_cart_summary(self):
+        '''
+        Return the number of lines, the sum of their quantities and the
+        amounts of the order with a single aggregate query, so that the cost
+        does not depend on the number of lines.
+
+        The amounts are read from the cache stored by
+        :meth:`store_cart_cache`. They are only computed, and then stored,
+        if the lines changed since they were stored.
+
+        :return: A dictionary with `lines`, `quantity`, `untaxed_amount`,
+                 `tax_amount` and `total_amount`
+        '''
+        SaleLine = Pool().get('sale.line')
+
+        sale = self.__table__()
+        line = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        amount_columns = [
+            sale.untaxed_amount_cache,
+            sale.tax_amount_cache,
+            sale.total_amount_cache,
+        ]
+        cursor.execute(*sale.join(
+            line, 'LEFT',
+            condition=(line.sale == sale.id) & (line.type == 'line')
+        ).select(
+            Count(line.id), Sum(line.quantity), *amount_columns,
+            where=(sale.id == self.id),
+            group_by=[sale.id] + amount_columns
+        ))
+        lines, quantity, untaxed_amount, tax_amount, total_amount = \
+            cursor.fetchone()
+
+        if None in (untaxed_amount, tax_amount, total_amount):
+            untaxed_amount = self.untaxed_amount
+            tax_amount = self.tax_amount
+            total_amount = self.total_amount
+            self.store_cart_cache(untaxed_amount, tax_amount, total_amount)
+
+        return {
+            'lines': lines,
+            'quantity': quantity or 0,
+            'untaxed_amount': untaxed_amount,
+            'tax_amount': tax_amount,
+            'total_amount': total_amount,
+        }
 
     def refresh_taxes(self):
         '''
@@ -81,6 +648,109 @@ class Sale:
         for line in self.lines:
             line.refresh_taxes()
 
+    def validate_cart_inventory(self, lines=None):
+        '''
+        Validate all the lines of the order against the inventory of their
+        products in one pass. Unlike
+        :meth:`SaleLine.validate_for_product_inventory`, all the failing lines
+        are reported and the availability of the products is computed once
+        for the whole order.
+
+        :param lines: List of sale line active records of the order to
+                      validate, all the lines if not given
+        :return: A list with a dictionary for each line which failed with the
+                 `line` ID, the `product` ID, the `quantity` of the line and
+                 the `available_quantity` of the product
+        '''
+        Product = Pool().get('product.product')
+
+        lines = [
+            line for line in (self.lines if lines is None else lines)
+            if line.type == 'line' and line.product
+        ]
+        # Only goods which are not sold on back order need the stock
+        products = list(set(
+            line.product for line in lines
+            if line.product.type == 'goods' and not line.product.is_backorder
+        ))
+        quantities = Product.get_available_quantities(products)
+
+        failures = []
+        for line in lines:
+            if line.product.id not in quantities:
+                continue
+            available_quantity = quantities[line.product.id]
+            if not line.product.can_buy_from_eshop(available_quantity):
+                failures.append({
+                    'line': line.id,
+                    'product': line.product.id,
+                    'quantity': line.quantity,
+                    'available_quantity': available_quantity,
+                })
+        return failures
+
+    def get_price_changes(self):
+        '''
+        Reprice all the lines of the order for its customer, price list and
+        currency and return the lines whose unit price changed.
+
+        The lines are priced together by :meth:`SaleLine.get_cart_unit_prices`
+        which needs only one price computation per unit and quantity in the
+        order. Nothing is written, so this can be used to show the changes
+        on the cart page, for example with
+        ``cart.sale.get_price_changes()`` in the template.
+
+        :return: A list with a dictionary for each changed line with the
+                 `line` ID, the `product` ID, the `old_unit_price` and the new
+                 `unit_price`
+        '''
+        SaleLine = Pool().get('sale.line')
+
+        prices = SaleLine.get_cart_unit_prices(self.lines)
+
+        changes = []
+        for line in self.lines:
+            if line.id in prices and prices[line.id] != line.unit_price:
+                changes.append({
+                    'line': line.id,
+                    'product': line.product.id,
+                    'old_unit_price': line.unit_price,
+                    'unit_price': prices[line.id],
+                })
+        return changes
+
+    def notify_price_changes(self):
+        '''
+        Flash a message for each line of the order repriced by
+        :meth:`reprice_carts` since the cart was last viewed, like the
+        messages of :meth:`_add_or_update`, and forget the previous prices.
+
+        The previous prices are cleared by a single update which does not
+        change the revision of the cart.
+        '''
+        SaleLine = Pool().get('sale.line')
+
+        line_table = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        lines = SaleLine.search([
+            ('sale', '=', self.id),
+            ('cart_old_unit_price', '!=', None),
+        ])
+        if not lines:
+            return
+        for line in lines:
+            self._flash_price_change(
+                line.product, line.cart_old_unit_price, line.unit_price
+            )
+        line_ids = map(int, lines)
+        cursor.execute(*line_table.update(
+            columns=[line_table.cart_old_unit_price],
+            values=[Null],
+            where=reduce_ids(line_table.id, line_ids)
+        ))
+        clean_transaction_cache(SaleLine.__name__, line_ids)
+
     def find_existing_line(self, product_id):
         """Return existing sale line for given product"""
         SaleLine = Pool().get('sale.line')
@@ -91,6 +761,46 @@ class Sale:
         ])
         return lines[0] if lines else None
 
+    def update_cart_lines(self, quantities=None, delete=None):
+        """
+        Change the quantities of and delete several lines of the order at
+        once.
+
+        The lines to delete are deleted with a single call, the changed
+        lines are repriced together with :meth:`SaleLine.get_cart_unit_prices`
+        and written with a single call, grouped by their new quantity and
+        price.
+
+        :param quantities: Dictionary mapping sale line active records of the
+                           order to their new quantity
+        :param delete: List of sale line active records of the order to
+                       delete
+        """
+        SaleLine = Pool().get('sale.line')
+
+        if delete:
+            SaleLine.delete(delete)
+
+        lines = []
+        for line, quantity in (quantities or {}).iteritems():
+            line.quantity = quantity
+            lines.append(line)
+        if not lines:
+            return
+
+        prices = SaleLine.get_cart_unit_prices(lines)
+        lines_by_values = defaultdict(list)
+        for line in lines:
+            price = prices.get(line.id, line.unit_price)
+            lines_by_values[(line.quantity, price)].append(line)
+        args = []
+        for (quantity, price), value_lines in lines_by_values.iteritems():
+            args.extend([value_lines, {
+                'quantity': quantity,
+                'unit_price': price,
+            }])
+        SaleLine.write(*args)
+
     def _add_or_update(self, product_id, quantity, action='set'):
         '''Add item as a line or if a line with item exists
         update it for the quantity
@@ -138,31 +848,81 @@ class Sale:
         values.update(SaleLine(**values).on_change_quantity())
 
         if old_price and old_price != values['unit_price']:
-            vals = (
-                product.name, self.currency.symbol, old_price,
-                self.currency.symbol, values['unit_price']
-            )
-            if old_price < values['unit_price']:
-                message = _(
-                    "The unit price of product %s increased from %s%d to "
-                    "%s%d." % vals
-                )
-            else:
-                message = _(
-                    "The unit price of product %s dropped from %s%d "
-                    "to %s%d." % vals
-                )
-            flash(message)
+            self._flash_price_change(product, old_price, values['unit_price'])
 
         for key, value in values.iteritems():
             if '.' not in key:
                 setattr(order_line, key, value)
         return order_line
 
+    def _flash_price_change(self, product, old_price, unit_price):
+        '''Flash a message telling that the unit price of the product in
+        the order changed
+
+        :param product: Active record of the product
+        :param old_price: Previous unit price
+        :param unit_price: New unit price
+        '''
+        vals = (
+            product.name, self.currency.symbol, old_price,
+            self.currency.symbol, unit_price
+        )
+        if old_price < unit_price:
+            message = _(
+                "The unit price of product %s increased from %s%d to "
+                "%s%d." % vals
+            )
+        else:
+            message = _(
+                "The unit price of product %s dropped from %s%d "
+                "to %s%d." % vals
+            )
+        flash(message)
+
 
 class SaleLine:
     __name__ = 'sale.line'
 
+    #: Unit price of the line before it was repriced by
+    #: :meth:`sale.sale.reprice_carts`, until the shopper is told about it
+    cart_old_unit_price = fields.Numeric(
+        'Cart Old Unit Price', digits=(16, 4), readonly=True
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(SaleLine, cls).create(vlist)
+        cls._update_carts(lines)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        super(SaleLine, cls).write(*args)
+        cls._update_carts(sum(args[::2], []))
+
+    @classmethod
+    def delete(cls, lines):
+        sales = set(line.sale.id for line in lines if line.sale)
+        super(SaleLine, cls).delete(lines)
+        cls._update_carts(sales=sales)
+
+    @classmethod
+    def _update_carts(cls, lines=None, sales=None):
+        '''
+        Clear the stored amounts and bump the revision of the carts of the
+        given lines
+
+        :param lines: List of sale line active records which changed
+        :param sales: IDs of the sales whose lines changed
+        '''
+        Sale = Pool().get('sale.sale')
+        Cart = Pool().get('nereid.cart')
+
+        sales = set(sales or [])
+        sales.update(line.sale.id for line in (lines or []) if line.sale)
+        Sale.clear_cart_cache(list(sales))
+        Cart.bump_revision(sales=list(sales))
+
     def refresh_taxes(self):
         "Refresh taxes of sale line"
         SaleLine = Pool().get('sale.line')
@@ -172,43 +932,122 @@ class SaleLine:
             self.taxes = values['taxes']
             self.save()
 
+    @classmethod
+    def get_cart_unit_prices(cls, lines):
+        """
+        Return the current unit price of the given lines as a dictionary
+        mapping line ID to the price. Lines without a product are skipped.
+
+        The lines are grouped by their pricing context (customer, price list,
+        currency, unit) and quantity, and each group is priced with a single
+        call to `get_sale_price`, instead of one on_change per line.
+
+        :param lines: List of sale line active records
+        """
+        Product = Pool().get('product.product')
+
+        digits = Decimal(1) / 10 ** cls.unit_price.digits[1]
+
+        lines_by_context = defaultdict(list)
+        for line in lines:
+            if line.type != 'line' or not line.product:
+                continue
+            key = (
+                tuple(sorted(line._get_context_sale_price().items())),
+                line.quantity or 0,
+            )
+            lines_by_context[key].append(line)
+
+        prices = {}
+        for key, context_lines in lines_by_context.iteritems():
+            context, quantity = key
+            products = list(set(line.product for line in context_lines))
+            with Transaction().set_context(dict(context)):
+                product_prices = Product.get_sale_price(products, quantity)
+            for line in context_lines:
+                price = product_prices[line.product.id]
+                if price:
+                    price = price.quantize(digits)
+                prices[line.id] = price
+        return prices
+
     def serialize(self, purpose=None):
         """
         Serialize SaleLine data
         """
-        res = {}
         if purpose == 'cart':
-            currency_format = partial(
-                numbers.format_currency, currency=self.sale.currency.code,
-                locale=request.nereid_language.code
-            )
-            number_format = partial(
-                numbers.format_number, locale=request.nereid_language.code
+            return self.serialize_cart_lines([self])[0]
+        elif hasattr(super(SaleLine, self), 'serialize'):
+            return super(SaleLine, self).serialize(purpose)  # pragma: no cover
+        return {}
+
+    @classmethod
+    def serialize_cart_lines(cls, lines):
+        """
+        Serialize the given lines for the cart. Returns the list of
+        dictionaries that :meth:`serialize` returns for each line when the
+        purpose is `cart`.
+
+        The lines, and then their products, are read together instead of
+        one by one and the serialized product, its image and its URL are
+        built only once per product.
+
+        :param lines: List of sale line active records
+        """
+        Product = Pool().get('product.product')
+
+        # Browse again so that all the lines share the same cache and their
+        # fields are read together
+        lines = cls.browse(map(int, lines))
+        products = Product.browse(list(set(
+            line.product.id for line in lines if line.product
+        )))
+
+        product_data = {}
+        for product in products:
+            serialized_product = product.serialize(purpose='cart')
+            product_data[product.id] = {
+                'url': product.get_absolute_url(_external=True),
+                'image': serialized_product['image'],
+                'product': serialized_product,
+            }
+
+        number_format = get_number_format(request.nereid_language.code)
+
+        res = []
+        for line in lines:
+            currency_format = get_currency_format(
+                line.sale.currency.code, request.nereid_language.code
             )
-            res.update({
-                'id': self.id,
+            data = product_data.get(line.product and line.product.id, {})
+            res.append({
+                'id': line.id,
                 'display_name': (
-                    self.product and self.product.name or self.description
+                    line.product and line.product.name or line.description
                 ),
-                'url': self.product.get_absolute_url(_external=True),
-                'image': (
-                    self.product.default_image.transform_command().thumbnail(
-                        150, 150, 'a'
-                    ).url() if self.product.default_image else None
-                ),
-                'product': self.product.serialize(purpose),
-                'quantity': number_format(self.quantity),
-                'unit': self.unit.symbol,
-                'unit_price': currency_format(self.unit_price),
-                'amount': currency_format(self.amount),
+                'url': data.get('url'),
+                'image': data.get('image'),
+                'product': data.get('product'),
+                'quantity': number_format(line.quantity),
+                'unit': line.unit.symbol,
+                'unit_price': currency_format(line.unit_price),
+                'amount': currency_format(line.amount),
                 'remove_url': url_for(
-                    'nereid.cart.delete_from_cart', line=self.id
+                    'nereid.cart.delete_from_cart', line=line.id
                 ),
             })
-        elif hasattr(super(SaleLine, self), 'serialize'):
-            return super(SaleLine, self).serialize(purpose)  # pragma: no cover
         return res
 
+    def get_cart_create_values(self):
+        """
+        Returns the values to create this new line of a cart, as set by
+        :meth:`sale.sale._add_or_update` and the on_change methods it calls,
+        so that several new lines can be created with a single call. All
+        the values set on the line are kept, including those of the fields
+        added by other modules.
+        """
+        return self._save_values
+
     def add_to(self, sale):
         """
         Copy sale_line to new sale.
@@ -230,3 +1069,222 @@ class SaleLine:
         if has_request_context() and not self.product.can_buy_from_eshop():
             flash(_('This product is no longer available'))
             abort(redirect(request.referrer))
+
+
+class LatestCartSale(ModelSQL):
+    """
+    The latest draft cart sale of a party on a website in a currency, which
+    :meth:`nereid.cart.open_cart` attaches to a new cart of the party
+    without searching the sales of the party.
+
+    It is kept up to date by :class:`Sale` whenever a cart sale is created,
+    deleted or changes state, party, currency or website.
+    """
+    __name__ = 'sale.sale.latest_cart'
+
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    website = fields.Many2One(
+        'nereid.website', 'Website', required=True, ondelete='CASCADE'
+    )
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, ondelete='CASCADE'
+    )
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, ondelete='CASCADE'
+    )
+
+    #: The fields of sales which decide if a sale is the latest cart sale
+    sale_fields = ['state', 'is_cart', 'party', 'website', 'currency']
+
+    @classmethod
+    def __setup__(cls):
+        super(LatestCartSale, cls).__setup__()
+        cls._sql_constraints += [
+            ('party_website_currency_uniq', 'UNIQUE(party, website, currency)',
+                'There can be only one latest cart sale per party, website '
+                'and currency.'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Website = pool.get('nereid.website')
+        NereidUser = pool.get('nereid.user')
+
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(LatestCartSale, cls).__register__(module_name)
+
+        if created:
+            # Find the latest cart sales among the existing sales
+            table = cls.__table__()
+            sale = Sale.__table__()
+            website = Website.__table__()
+            user = NereidUser.__table__()
+            cursor.execute(*table.insert(
+                columns=[
+                    table.create_uid, table.create_date, table.party,
+                    table.website, table.currency, table.sale,
+                ],
+                values=sale.join(
+                    website, condition=sale.website == website.id
+                ).join(
+                    user, condition=website.guest_user == user.id
+                ).select(
+                    Literal(0), Now(), sale.party, sale.website,
+                    sale.currency, Max(sale.id),
+                    where=(
+                        (sale.state == 'draft')
+                        & (sale.is_cart == Literal(True))
+                        & (sale.party != user.party)
+                    ),
+                    group_by=[sale.party, sale.website, sale.currency]
+                )
+            ))
+
+    @staticmethod
+    def get_keys(sales):
+        """
+        Return the set of (website ID, party ID, currency ID) of the given
+        sales which are cart sales of registered users. The sales of the
+        guest users are never attached to a new cart.
+        """
+        return set(
+            (sale.website.id, sale.party.id, sale.currency.id)
+            for sale in sales
+            if sale.is_cart and sale.website and sale.party
+            and sale.currency
+            and sale.party != sale.website.guest_user.party
+        )
+
+    @classmethod
+    def get_sale(cls, website_id, party_id, currency_id):
+        """
+        Return the latest draft cart sale of the party on the website in the
+        currency, or None
+        """
+        records = cls.search([
+            ('party', '=', party_id),
+            ('website', '=', website_id),
+            ('currency', '=', currency_id),
+        ], limit=1)
+        return records[0].sale if records else None
+
+    @classmethod
+    def set_latest(cls, sales):
+        """
+        Make the given new sales the latest cart sales of their keys
+
+        :param sales: List of sale active records which were just created
+        """
+        latest = {}
+        for sale in sorted(sales, key=int):
+            if sale.state != 'draft':
+                continue
+            for key in cls.get_keys([sale]):
+                latest[key] = sale.id
+        cls._store_latest(latest)
+
+    @classmethod
+    def update_latest(cls, keys):
+        """
+        Find again the latest draft cart sale of the given keys
+
+        :param keys: Set of (website ID, party ID, currency ID)
+        """
+        Sale = Pool().get('sale.sale')
+
+        latest = {}
+        for key in keys:
+            sales = Sale.search(
+                Sale._get_abandoned_cart_domain(*key),
+                order=[('id', 'DESC')], limit=1
+            )
+            latest[key] = sales[0].id if sales else None
+        cls._store_latest(latest)
+
+    @classmethod
+    def _store_latest(cls, latest):
+        """
+        Store the latest cart sales
+
+        The latest cart sale of a key may be created meanwhile by a
+        concurrent transaction. The creations for a party are serialized by
+        locking the party, and the committed latest cart sales are looked up
+        again once the lock is held, see :meth:`_created_concurrently`. The
+        one created concurrently is then kept, since it is a draft cart sale
+        of the key too, and it is replaced the next time a cart sale of the
+        key changes.
+
+        :param latest: Dictionary mapping (website ID, party ID, currency ID)
+                       to the ID of the latest draft cart sale or None
+        """
+        to_create, to_delete = [], []
+        for (website_id, party_id, currency_id), sale_id in \
+                latest.iteritems():
+            records = cls.search([
+                ('party', '=', party_id),
+                ('website', '=', website_id),
+                ('currency', '=', currency_id),
+            ], limit=1)
+            if not sale_id:
+                to_delete.extend(records)
+            elif not records:
+                to_create.append({
+                    'party': party_id,
+                    'website': website_id,
+                    'currency': currency_id,
+                    'sale': sale_id,
+                })
+            elif records[0].sale.id != sale_id:
+                cls.write(records, {'sale': sale_id})
+        if to_delete:
+            cls.delete(to_delete)
+        for values in to_create:
+            if cls._created_concurrently(values):
+                logger.info(
+                    'Latest cart sale of party %d created concurrently',
+                    values['party']
+                )
+                continue
+            cls.create([values])
+
+    @classmethod
+    def _created_concurrently(cls, values):
+        """
+        Lock the party of the latest cart sale to create, until the end of
+        the transaction, and return True if a latest cart sale of its key
+        was committed by another transaction.
+
+        The transaction only sees the rows committed when it started, so the
+        committed rows are read with a new cursor. SQLite serializes the
+        transactions, so nothing is done there.
+
+        :param values: Dictionary of the values of the latest cart sale
+        """
+        Party = Pool().get('party.party')
+
+        if backend.name() == 'sqlite':
+            return False
+
+        party = Party.__table__()
+        table = cls.__table__()
+        Transaction().cursor.execute(*party.select(
+            party.id, where=party.id == values['party'],
+            for_=For('UPDATE')
+        ))
+        with Transaction().new_cursor():
+            cursor = Transaction().cursor
+            cursor.execute(*table.select(
+                table.id,
+                where=(table.party == values['party'])
+                & (table.website == values['website'])
+                & (table.currency == values['currency'])
+            ))
+            return bool(cursor.fetchall())
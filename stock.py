@@ -0,0 +1,56 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.stock
+
+    Purge the cached availability of products when their stock changes
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from trytond.pool import PoolMeta
+
+from .purge import product_key, location_key, purge_enabled, purge
+
+__all__ = ['Move']
+__metaclass__ = PoolMeta
+
+
+class Move:
+    "Stock Move"
+    __name__ = 'stock.move'
+
+    @classmethod
+    def create(cls, vlist):
+        moves = super(Move, cls).create(vlist)
+        cls._purge_availability(moves)
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        moves = sum(args[::2], [])
+        # Purge the old products and locations too
+        cls._purge_availability(moves)
+        super(Move, cls).write(*args)
+        cls._purge_availability(moves)
+
+    @classmethod
+    def delete(cls, moves):
+        cls._purge_availability(moves)
+        super(Move, cls).delete(moves)
+
+    @classmethod
+    def _purge_availability(cls, moves):
+        """
+        Purge the availability responses of the products of the moves and of
+        the locations they move from or to.
+
+        :param moves: List of stock move active records
+        """
+        if not purge_enabled():
+            return
+        keys = set()
+        for move in moves:
+            keys.add(product_key(move.product.id))
+            keys.add(location_key(move.from_location.id))
+            keys.add(location_key(move.to_location.id))
+        purge(keys)
@@ -0,0 +1,30 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.tax
+
+    Clear the stored amounts of the open carts when their taxes change
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Tax']
+__metaclass__ = PoolMeta
+
+
+class Tax:
+    "Account Tax"
+    __name__ = 'account.tax'
+
+    @classmethod
+    def write(cls, *args):
+        super(Tax, cls).write(*args)
+
+        # The lines have the parent of a changed child tax
+        taxes = set()
+        for tax in sum(args[::2], []):
+            while tax and tax.id not in taxes:
+                taxes.add(tax.id)
+                tax = tax.parent
+        Pool().get('sale.sale').update_open_carts(taxes=list(taxes))
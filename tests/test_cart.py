@@ -7,11 +7,14 @@
     :copyright: (c) 2010-2013 by Openlabs Technologies & Consulting (P) Ltd.
     :license: GPLv3, see LICENSE for more details
 '''
+import datetime
+import json
 import unittest
 from decimal import Decimal
 
 from nereid import request
 from nereid.globals import session
+from trytond import backend
 from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT, POOL
 from trytond.transaction import Transaction
 
@@ -455,7 +458,10 @@ class TestCart(BaseTestCase):
             with app.test_client() as c:
                 rv = c.get('/cart')
                 self.assertEqual(rv.status_code, 200)
-                self.assertEqual(rv.headers['Cache-Control'], 'max-age=0')
+                self.assertEqual(
+                    rv.headers['Cache-Control'], 'private, max-age=0'
+                )
+                self.assertEqual(rv.headers['Vary'], 'Cookie')
 
     def test_0120_add_non_salable_product_to_cart(self):
         """
@@ -595,6 +601,947 @@ class TestCart(BaseTestCase):
                 self.assertTrue('Cart:1,1,10.00' in rv.data)
                 self.assertTrue('increased from' in rv.data)
 
+    def test_0150_reprice_carts(self):
+        """
+        Reprice the open carts in bulk after a price list change
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                rv = c.get('/cart')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'Cart:1,7,70.00')
+
+                sale, = self.Sale.search([])
+                self.assertFalse(sale.cart_to_reprice)
+                # Nothing changed, so no cart is marked to reprice
+                self.assertEqual(
+                    self.Sale.reprice_carts(marked_only=True), 0
+                )
+
+                price_list_line, = sale.price_list.lines
+                price_list_line.formula = 'unit_price * 2'
+                price_list_line.save()
+                self.assertTrue(self.Sale(sale.id).cart_to_reprice)
+
+                last_id = self.Sale.reprice_carts(
+                    price_lists=[sale.price_list.id], marked_only=True
+                )
+                self.assertEqual(last_id, sale.id)
+                self.assertFalse(self.Sale(sale.id).cart_to_reprice)
+
+                line, = SaleLine.search([])
+                self.assertEqual(line.unit_price, Decimal('20'))
+                self.assertEqual(line.cart_old_unit_price, Decimal('10'))
+
+                # Resuming after the last cart has nothing left to do
+                self.assertEqual(
+                    self.Sale.reprice_carts(start_id=last_id), last_id
+                )
+
+                # The shopper is told about the change once
+                rv = c.get('/cart')
+                self.assertTrue('increased from' in rv.data)
+                self.assertEqual(
+                    SaleLine(line.id).cart_old_unit_price, None
+                )
+                rv = c.get('/cart')
+                self.assertFalse('increased from' in rv.data)
+
+                # Changing the list price of a product marks its carts
+                self.template1.list_price = Decimal('15')
+                self.template1.save()
+                self.assertTrue(self.Sale(sale.id).cart_to_reprice)
+                self.assertEqual(
+                    self.Sale.reprice_carts(marked_only=True), sale.id
+                )
+                self.assertEqual(
+                    SaleLine(line.id).unit_price, Decimal('30')
+                )
+
+    def test_0160_cart_price_changes(self):
+        """
+        Find the lines of the cart whose price changed
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                for product in (self.product1, self.product2):
+                    c.post(
+                        '/cart/add',
+                        data={
+                            'product': product.id, 'quantity': 2
+                        }
+                    )
+
+            sale, = self.Sale.search([])
+            self.assertEqual(sale.get_price_changes(), [])
+
+            price_list, = self.PriceList.create([{
+                'name': 'Product 1 discount',
+                'company': self.company.id,
+                'lines': [
+                    ('create', [{
+                        'product': self.product1.id,
+                        'formula': 'unit_price - 1',
+                    }])
+                ],
+            }])
+            sale.price_list = price_list
+            sale.save()
+
+            line = sale.find_existing_line(self.product1.id)
+            self.assertEqual(
+                self.Sale(sale.id).get_price_changes(), [{
+                    'line': line.id,
+                    'product': self.product1.id,
+                    'old_unit_price': Decimal('10'),
+                    'unit_price': Decimal('9'),
+                }]
+            )
+
+    def test_0170_cart_summary(self):
+        """
+        Test the line count, quantity and amounts of the cart summary
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            self.template1.customer_taxes = [self.sale_tax.id]
+            self.template1.save()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                for product in (self.product1, self.product2):
+                    c.post(
+                        '/cart/add',
+                        data={
+                            'product': product.id, 'quantity': 7
+                        }
+                    )
+                rv = c.get('/cart')
+                self.assertEqual(rv.status_code, 200)
+                # 140 (10 x 7 x 2) + 3.5 (5% Tax on product 1) = 143.50
+                self.assertEqual(rv.data, 'Cart:1,14,143.50')
+
+            sale, = self.Sale.search([])
+            self.assertEqual(sale.untaxed_amount_cache, Decimal('140'))
+            self.assertEqual(sale.get_cart_summary(), {
+                'lines': 2,
+                'quantity': 14,
+                'untaxed_amount': Decimal('140'),
+                'tax_amount': Decimal('3.50'),
+                'total_amount': Decimal('143.50'),
+            })
+
+            # The stored amounts are cleared when the lines change and
+            # stored again once computed
+            line = sale.find_existing_line(self.product2.id)
+            SaleLine.delete([line])
+            self.assertIsNone(self.Sale(sale.id).untaxed_amount_cache)
+            summary = self.Sale(sale.id).get_cart_summary()
+            self.assertEqual(
+                self.Sale(sale.id).untaxed_amount_cache, Decimal('70')
+            )
+            self.assertEqual(summary['lines'], 1)
+            self.assertEqual(summary['quantity'], 7)
+            self.assertEqual(summary['total_amount'], Decimal('73.50'))
+
+            # And when the taxes of the lines change
+            self.sale_tax.rate = Decimal('0.1')
+            self.sale_tax.save()
+            self.assertIsNone(self.Sale(sale.id).untaxed_amount_cache)
+            summary = self.Sale(sale.id).get_cart_summary()
+            self.assertEqual(summary['tax_amount'], Decimal('7'))
+            self.assertEqual(summary['total_amount'], Decimal('77'))
+
+    def test_0180_cart_summary_view(self):
+        """
+        Test the cart summary and that an unchanged summary is not sent again
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                rv = c.get('/cart/summary')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(json.loads(rv.data), {
+                    'items': 0, 'quantity': 0, 'total_amount': '$0.00',
+                })
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                rv = c.get('/cart/summary')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(json.loads(rv.data), {
+                    'items': 1, 'quantity': 7, 'total_amount': '$70.00',
+                })
+                etag = rv.headers['ETag']
+
+                rv = c.get('/cart/summary', headers=[('If-None-Match', etag)])
+                self.assertEqual(rv.status_code, 304)
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id,
+                        'quantity': 1, 'action': 'add'
+                    }
+                )
+                rv = c.get('/cart/summary', headers=[('If-None-Match', etag)])
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(json.loads(rv.data)['quantity'], 8)
+                self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_0190_cart_revision_etag(self):
+        """
+        Test that the cart responses are not sent again until the cart
+        changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            # Flashed messages are never cached, so show them
+            self.templates.update({
+                'shopping-cart.jinja':
+                    'Cart:{{ cart.id }},{{get_cart_size()|round|int}},'
+                    '{{get_flashed_messages()}}',
+                'shopping-cart-esi.jinja':
+                    'ESI:{{ cart.id }},{{get_cart_size()|round|int}}',
+            })
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                cart, = self.Cart.search([])
+                revision = cart.revision
+
+                etags = {}
+                for url in ('/cart', '/esi/cart'):
+                    rv = c.get(url)
+                    self.assertEqual(rv.status_code, 200)
+                    etags[url] = rv.headers['ETag']
+
+                    rv = c.get(url, headers=[('If-None-Match', etags[url])])
+                    self.assertEqual(rv.status_code, 304)
+                self.assertNotEqual(etags['/cart'], etags['/esi/cart'])
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product2.id, 'quantity': 1
+                    }
+                )
+                self.assertTrue(self.Cart(cart.id).revision > revision)
+
+                for url in ('/cart', '/esi/cart'):
+                    rv = c.get(url, headers=[('If-None-Match', etags[url])])
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertNotEqual(rv.headers['ETag'], etags[url])
+
+    def test_0200_cart_esi_cache(self):
+        """
+        Test that the ESI fragment of a cart is rendered again only when the
+        cart changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.templates['shopping-cart-esi.jinja'] = \
+                'ESI:{{get_cart_size()|round|int}}{{get_flashed_messages()}}'
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                # Consume the flashed message
+                rv = c.get('/esi/cart')
+                self.assertTrue(rv.data.startswith('ESI:7'))
+
+                rv = c.get('/esi/cart')
+                self.assertEqual(rv.data, 'ESI:7[]')
+                # The fragment of a session is never stored by the proxy
+                self.assertNotIn('Surrogate-Control', rv.headers)
+                self.assertEqual(
+                    rv.headers['Cache-Control'], 'private, max-age=0'
+                )
+
+                # The cached fragment is served while the cart is unchanged
+                self.templates['shopping-cart-esi.jinja'] = \
+                    'Changed:{{get_cart_size()|round|int}}'
+                rv = c.get('/esi/cart')
+                self.assertEqual(rv.data, 'ESI:7[]')
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 8
+                    }
+                )
+                rv = c.get('/esi/cart')
+                self.assertEqual(rv.data, 'Changed:8')
+
+    def test_0210_cart_json_fields(self):
+        """
+        Test that the XHR cart returns only the fields asked for
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            xhr = [('X-Requested-With', 'XMLHttpRequest')]
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                line, = POOL.get('sale.line').search([])
+
+                rv = c.get('/cart', headers=xhr)
+                cart = json.loads(rv.data)['cart']
+                self.assertEqual(
+                    set(cart.keys()), set([
+                        'lines', 'empty', 'total_amount', 'tax_amount',
+                        'untaxed_amount',
+                    ])
+                )
+                self.assertEqual(
+                    set(cart['lines'][0].keys()), set([
+                        'product', 'quantity', 'unit', 'unit_price',
+                        'amount',
+                    ])
+                )
+                etag = rv.headers['ETag']
+
+                rv = c.get(
+                    '/cart?fields=lines.id,lines.quantity,total_amount',
+                    headers=xhr
+                )
+                cart = json.loads(rv.data)['cart']
+                self.assertEqual(
+                    set(cart.keys()), set(['lines', 'total_amount'])
+                )
+                self.assertEqual(
+                    cart['lines'], [{'id': line.id, 'quantity': u'7'}]
+                )
+                self.assertNotEqual(rv.headers['ETag'], etag)
+
+                rv = c.get('/cart?fields=lines.secret', headers=xhr)
+                self.assertEqual(rv.status_code, 400)
+
+    def test_0220_cart_json_paging(self):
+        """
+        Test that the lines of the XHR cart can be paged and streamed
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            xhr = [('X-Requested-With', 'XMLHttpRequest')]
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                for product in (self.product1, self.product2):
+                    c.post(
+                        '/cart/add',
+                        data={
+                            'product': product.id, 'quantity': 7
+                        }
+                    )
+                line1, line2 = POOL.get('sale.line').search(
+                    [], order=[('id', 'ASC')]
+                )
+
+                rv = c.get('/cart?fields=lines.id&limit=1', headers=xhr)
+                cart = json.loads(rv.data)['cart']
+                self.assertEqual(cart['lines'], [{'id': line1.id}])
+                self.assertEqual(cart['next'], line1.id)
+
+                rv = c.get(
+                    '/cart?fields=lines.id&limit=1&after=%d' % line1.id,
+                    headers=xhr
+                )
+                cart = json.loads(rv.data)['cart']
+                self.assertEqual(cart['lines'], [{'id': line2.id}])
+                self.assertEqual(cart['next'], None)
+
+                rv = c.get('/cart', headers=xhr)
+                expected = json.loads(rv.data)
+
+                rv = c.get('/cart?stream=1', headers=xhr)
+                self.assertEqual(json.loads(rv.data), expected)
+
+                rv = c.get('/cart?fields=lines.id&stream=1', headers=xhr)
+                self.assertEqual(
+                    json.loads(rv.data), {
+                        'cart': {
+                            'lines': [{'id': line1.id}, {'id': line2.id}],
+                        }
+                    }
+                )
+
+    def test_0230_cart_changes_with_summary(self):
+        """
+        Test that the XHR responses of the cart changes have the state of
+        the cart when asked for
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            xhr = [('X-Requested-With', 'XMLHttpRequest')]
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                rv = c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    },
+                    headers=xhr
+                )
+                self.assertFalse('cart' in json.loads(rv.data))
+
+                rv = c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product2.id, 'quantity': 3,
+                        'summary': 1,
+                    },
+                    headers=xhr
+                )
+                data = json.loads(rv.data)['cart']
+                self.assertEqual(data['items'], 2)
+                self.assertEqual(data['quantity'], 10)
+                cart, = self.Cart.search([])
+                self.assertEqual(data['revision'], cart.revision)
+
+                line, = POOL.get('sale.line').search([
+                    ('product', '=', self.product2.id)
+                ])
+                rv = c.post(
+                    '/cart/delete/%d' % line.id, data={'summary': 1},
+                    headers=xhr
+                )
+                data2 = json.loads(rv.data)['cart']
+                self.assertEqual(data2['items'], 1)
+                self.assertEqual(data2['quantity'], 7)
+                self.assertTrue(data2['revision'] > data['revision'])
+
+                rv = c.post('/cart/clear', data={'summary': 1}, headers=xhr)
+                data = json.loads(rv.data)['cart']
+                self.assertEqual(data['items'], 0)
+                self.assertEqual(data['revision'], 0)
+
+    def test_0240_update_cart(self):
+        """
+        Test that several lines of the cart are changed and deleted at once
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            xhr = [('X-Requested-With', 'XMLHttpRequest')]
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                for product in (self.product1, self.product2):
+                    c.post(
+                        '/cart/add',
+                        data={
+                            'product': product.id, 'quantity': 7
+                        }
+                    )
+                line1, line2 = SaleLine.search([], order=[('id', 'ASC')])
+
+                # Nothing is changed if a change is wrong
+                rv = c.post(
+                    '/cart/update',
+                    data={
+                        'quantity-%d' % line1.id: 3,
+                        'quantity-%d' % (line2.id + 100): 3,
+                        'delete': line2.id,
+                    },
+                    headers=xhr
+                )
+                self.assertEqual(rv.status_code, 400)
+                self.assertEqual(SaleLine.search([], count=True), 2)
+
+                rv = c.post(
+                    '/cart/update',
+                    data={
+                        'quantity-%d' % line1.id: 3,
+                        'delete': line2.id,
+                    },
+                    headers=xhr
+                )
+                self.assertEqual(rv.status_code, 200)
+                data = json.loads(rv.data)['cart']
+                self.assertEqual(data['items'], 1)
+                self.assertEqual(data['quantity'], 3)
+
+                line, = SaleLine.search([])
+                self.assertEqual(line.quantity, 3)
+                self.assertEqual(line.amount, 3 * line.unit_price)
+
+                rv = c.open(
+                    '/cart/update', method='PATCH',
+                    data=json.dumps({'quantities': {str(line.id): 5}}),
+                    content_type='application/json',
+                    headers=xhr
+                )
+                self.assertEqual(json.loads(rv.data)['cart']['quantity'], 5)
+
+                # Quantities which are not finite numbers are rejected
+                for quantity in ('nan', 'inf', '-inf'):
+                    rv = c.post(
+                        '/cart/update',
+                        data={'quantity-%d' % line.id: quantity},
+                        headers=xhr
+                    )
+                    self.assertEqual(rv.status_code, 400)
+                rv = c.open(
+                    '/cart/update', method='PATCH',
+                    data='{"quantities": {"%d": NaN}}' % line.id,
+                    content_type='application/json',
+                    headers=xhr
+                )
+                self.assertEqual(rv.status_code, 400)
+                self.assertEqual(SaleLine(line.id).quantity, 5)
+
+                # The product of a changed line is no longer available
+                self.product1.min_warehouse_quantity = 1
+                self.product1.save()
+                rv = c.open(
+                    '/cart/update', method='PATCH',
+                    data=json.dumps({'quantities': {str(line.id): 2}}),
+                    content_type='application/json',
+                    headers=xhr
+                )
+                self.assertEqual(rv.status_code, 400)
+                self.assertEqual(SaleLine(line.id).quantity, 5)
+
+    def test_0250_archive_retired_carts(self):
+        """
+        Test that the retired carts are moved to the archive and that the
+        draft sale of an archived cart is used again
+        """
+        CartArchive = POOL.get('nereid.cart.archive')
+        CartLine = POOL.get('nereid.cart.line')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                cart, = self.Cart.search([])
+                sale = cart.sale
+
+                table = self.Cart.__table__()
+                long_ago = datetime.datetime.now() - \
+                    datetime.timedelta(days=31)
+
+                def age_carts():
+                    Transaction().cursor.execute(*table.update(
+                        columns=[table.create_date, table.write_date],
+                        values=[long_ago, long_ago]
+                    ))
+
+                age_carts()
+
+                # Carts with a draft sale are in use
+                self.assertEqual(self.Cart.archive_retired_carts(), 0)
+
+                # Carts with staged lines are never archived
+                staged_line, = CartLine.create([{
+                    'cart': cart.id,
+                    'product': self.product2.id,
+                    'quantity': 1,
+                    'unit': self.product2.sale_uom.id,
+                }])
+                age_carts()
+                self.assertEqual(
+                    self.Cart.archive_retired_carts(draft_delay=30), 0
+                )
+                CartLine.delete([staged_line])
+                age_carts()
+
+                self.assertEqual(
+                    self.Cart.archive_retired_carts(draft_delay=30), 1
+                )
+                self.assertEqual(self.Cart.search([], count=True), 0)
+                archive, = CartArchive.search([])
+                self.assertEqual(archive.cart, cart.id)
+                self.assertEqual(archive.sale, sale)
+                self.assertEqual(archive.user, cart.user)
+
+                # The new cart of the user gets the abandoned draft sale
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 8
+                    }
+                )
+                cart, = self.Cart.search([])
+                self.assertEqual(cart.sale, sale)
+
+    @unittest.skipIf(
+        backend.name() != 'sqlite', 'The query plans are checked on SQLite'
+    )
+    def test_0260_cart_lookups_use_indexes(self):
+        """
+        Test that the lookups of carts and abandoned cart sales are done
+        with an index
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            for quantity in range(1, 11):
+                with app.test_client() as c:
+                    c.post(
+                        '/cart/add',
+                        data={
+                            'product': self.product1.id,
+                            'quantity': quantity,
+                        }
+                    )
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+            cart, = self.Cart.search([('user', '!=', None)])
+            website = cart.website
+
+            cursor = Transaction().cursor
+
+            def assertUsesIndex(Model, domain, columns):
+                query, params = tuple(
+                    Model.search(domain, limit=1, query=True)
+                )
+                cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+                details = [row[-1] for row in cursor.fetchall()]
+                # The name given by the TableHandler of SQLite
+                index_name = '%s_%s_index' % (Model._table, '_'.join(columns))
+                self.assertTrue(
+                    any(
+                        Model._table in detail and index_name in detail
+                        for detail in details
+                    ),
+                    '%s does not use %s: %s' % (
+                        Model.__name__, index_name, details
+                    )
+                )
+
+            # The carts of guests and of users
+            assertUsesIndex(
+                self.Cart,
+                self.Cart._get_find_cart_domain(website.id, None, 'session'),
+                ['website', 'user', 'sessionid']
+            )
+            assertUsesIndex(
+                self.Cart,
+                self.Cart._get_find_cart_domain(
+                    website.id, cart.user.id, None
+                ),
+                ['website', 'user', 'sessionid']
+            )
+            # The abandoned cart sales of a party
+            assertUsesIndex(
+                self.Sale,
+                self.Sale._get_abandoned_cart_domain(
+                    website.id, cart.sale.party.id, cart.sale.currency.id
+                ),
+                ['party', 'website', 'currency', 'state', 'is_cart']
+            )
+
+    def test_0270_latest_cart_sale(self):
+        """
+        Test that the latest draft cart sale of a party is kept up to date
+        and attached to a new cart of the party
+        """
+        LatestCartSale = POOL.get('sale.sale.latest_cart')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                cart, = self.Cart.search([])
+                sale1 = cart.sale
+                key = (cart.website.id, sale1.party.id, sale1.currency.id)
+                self.assertEqual(LatestCartSale.get_sale(*key), sale1)
+
+                # The newest draft is the latest
+                sale2, = self.Sale.copy([sale1])
+                self.assertEqual(LatestCartSale.get_sale(*key), sale2)
+
+                # Until it is no more a draft
+                self.Sale.cancel([sale2])
+                self.assertEqual(LatestCartSale.get_sale(*key), sale1)
+
+                # The new cart of the user gets the latest draft sale
+                self.Cart.write([cart], {'sale': None})
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 8
+                    }
+                )
+                self.assertEqual(self.Cart(cart.id).sale, sale1)
+
+                self.Sale.cancel([sale1])
+                self.assertEqual(LatestCartSale.get_sale(*key), None)
+
+            # The sales of guests are never attached to a new cart
+            with app.test_client() as c:
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+            self.assertEqual(LatestCartSale.search([], count=True), 0)
+
+    def test_0280_request_cart(self):
+        """
+        Test that the cart of templates is shared within a request until it
+        changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/'):
+                cart = self.Cart.get_request_cart()
+                self.assertIs(self.Cart.get_request_cart(), cart)
+                self.assertEqual(self.Cart.get_request_cart_size(), 0)
+
+                self.Cart.open_cart(create_order=True)
+                cart = self.Cart.get_request_cart()
+                self.assertTrue(cart.sale)
+                self.assertIs(self.Cart.get_request_cart(), cart)
+
+                cart.sale._add_or_update(self.product1.id, 3).save()
+                self.assertEqual(self.Cart.get_request_cart_size(), 3)
+
+    def test_0290_staged_guest_cart(self):
+        """
+        Test that the products added to guest carts are staged without a
+        sale and moved to the sale of the user at login
+        """
+        CartLine = POOL.get('nereid.cart.line')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            self.NereidWebsite.write(
+                self.NereidWebsite.search([]), {'stage_guest_carts': True}
+            )
+
+            with app.test_client() as c:
+                c.post(
+                    '/cart/add',
+                    data={'product': self.product1.id, 'quantity': 5}
+                )
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 2,
+                        'action': 'add',
+                    }
+                )
+                self.assertFalse(self.Sale.search([]))
+                line, = CartLine.search([])
+                self.assertEqual(line.product, self.product1)
+                self.assertEqual(line.quantity, 7)
+
+                rv = c.get('/cart', headers=[
+                    ('X-Requested-With', 'XMLHttpRequest'),
+                ])
+                cart_data = json.loads(rv.data)['cart']
+                self.assertEqual(len(cart_data['lines']), 1)
+                self.assertTrue(cart_data['empty'])
+
+                # The status of the user shows the staged lines
+                rv = c.get('/user_status')
+                status = json.loads(rv.data)['status']
+                self.assertEqual(len(status['cart']['lines']), 1)
+                self.assertEqual(status['cart']['lines'][0]['id'], line.id)
+                self.assertEqual(float(status['cart_size']), 7)
+
+                # The summary is serialized in the currency of the lines
+                rv = c.get('/cart/summary')
+                self.assertEqual(rv.status_code, 200)
+                summary = json.loads(rv.data)
+                self.assertEqual(summary['items'], 1)
+                self.assertEqual(summary['quantity'], 7)
+                self.assertEqual(line.currency, self.usd)
+
+                self.login(c, 'email@example.com', 'password')
+
+            self.assertFalse(CartLine.search([]))
+            sale, = self.Sale.search([])
+            self.assertEqual(sale.party, self.registered_user.party)
+            self.assertEqual(len(sale.lines), 1)
+            self.assertEqual(sale.lines[0].quantity, 7)
+
+    def test_0300_buffered_cart_changes(self):
+        """
+        Test that the products added to carts are buffered and written to
+        the sale together
+        """
+        SaleLine = POOL.get('sale.line')
+        CartChange = POOL.get('nereid.cart.change')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            xhr = [('X-Requested-With', 'XMLHttpRequest')]
+            websites = self.NereidWebsite.search([])
+            self.NereidWebsite.write(websites, {
+                'buffer_cart_changes': True,
+                'cart_buffer_size': 3,
+                'cart_buffer_delay': 3600,
+            })
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                c.post(
+                    '/cart/add',
+                    data={'product': self.product1.id, 'quantity': 5}
+                )
+                rv = c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 2,
+                        'action': 'add', 'summary': 1,
+                    },
+                    headers=xhr
+                )
+                data = json.loads(rv.data)
+                self.assertTrue(data['line']['pending'])
+                self.assertEqual(data['cart']['items'], 1)
+                self.assertEqual(data['cart']['quantity'], 7)
+                self.assertFalse(SaleLine.search([]))
+                self.assertEqual(len(CartChange.search([])), 2)
+
+                # The buffer is full
+                c.post(
+                    '/cart/add',
+                    data={'product': self.product2.id, 'quantity': 3}
+                )
+                self.assertFalse(CartChange.search([]))
+                self.assertEqual(
+                    sorted(line.quantity for line in SaleLine.search([])),
+                    [3, 7]
+                )
+
+                # Viewing the cart writes the buffered changes
+                c.post(
+                    '/cart/add',
+                    data={'product': self.product2.id, 'quantity': 4}
+                )
+                self.assertTrue(CartChange.search([]))
+                rv = c.get('/cart')
+                self.assertEqual(rv.status_code, 200)
+                self.assertFalse(CartChange.search([]))
+                line, = SaleLine.search([
+                    ('product', '=', self.product2.id),
+                ])
+                self.assertEqual(line.quantity, 4)
+
+                # So does opening the cart for checkout
+                c.post(
+                    '/cart/add',
+                    data={'product': self.product2.id, 'quantity': 5}
+                )
+                self.assertTrue(CartChange.search([]))
+                # In the context of the last request
+                self.Cart.open_cart(create_order=True)
+                self.assertFalse(CartChange.search([]))
+                self.assertEqual(SaleLine(line.id).quantity, 5)
+
+            # The scheduler writes the expired changes
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post(
+                    '/cart/add',
+                    data={'product': self.product2.id, 'quantity': 6}
+                )
+            self.Cart.flush_expired_changes()
+            self.assertTrue(CartChange.search([]))
+            self.NereidWebsite.write(websites, {
+                'cart_buffer_delay': 0,
+            })
+            self.Cart.flush_expired_changes()
+            self.assertFalse(CartChange.search([]))
+            self.assertEqual(SaleLine(line.id).quantity, 6)
+
 
 def suite():
     "Cart test suite"
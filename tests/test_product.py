@@ -532,13 +532,19 @@ class TestProduct(BaseTestCase):
             self.setup_defaults()
             app = self.get_app()
 
+            website, = Website.search([])
+
             with app.test_client() as c:
                 rv = c.get('/product-availability/product-1')
                 availability = json.loads(rv.data)
                 self.assertEqual(availability['quantity'], 0.00)
                 self.assertEqual(availability['forecast_quantity'], 0.00)
+                self.assertEqual(
+                    rv.headers['Surrogate-Key'], 'location-%d product-%d' % (
+                        website.stock_location.id, self.product1.id
+                    )
+                )
 
-            website, = Website.search([])
             supplier, = Location.search([('code', '=', 'SUP')])
             stock1, = StockMove.create([{
                 'product': self.product1.id,
@@ -746,6 +752,143 @@ class TestProduct(BaseTestCase):
                 self.assertEqual(rv.status_code, 302)
                 self.assertEqual(SaleLine.search([], count=True), 1)
 
+    def test_0070_validate_cart_inventory(self):
+        """
+        Test that all the lines of a cart are validated against the inventory
+        in one pass
+        """
+        StockMove = POOL.get('stock.move')
+        Website = POOL.get('nereid.website')
+        Location = POOL.get('stock.location')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            website, = Website.search([])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            stock1, = StockMove.create([{
+                'product': self.product1.id,
+                'uom': self.template1.sale_uom.id,
+                'quantity': 10,
+                'from_location': supplier,
+                'to_location': website.stock_location.id,
+                'company': website.company.id,
+                'unit_price': Decimal('1'),
+                'currency': website.currencies[0].id,
+                'planned_date': datetime.date.today(),
+                'effective_date': datetime.date.today(),
+                'state': 'draft',
+            }])
+            StockMove.write([stock1], {
+                'state': 'done'
+            })
+
+            with app.test_request_context('/'):
+                cart = self.Cart.open_cart(create_order=True)
+                for product in (self.product1, self.product2):
+                    cart.sale._add_or_update(product.id, 5).save()
+
+                sale = self.Sale(cart.sale.id)
+                self.assertEqual(sale.validate_cart_inventory(), [])
+
+                # Available quantity is now less than warehouse quantity
+                self.product1.min_warehouse_quantity = 11
+                self.product1.save()
+                self.product2.min_warehouse_quantity = 1
+                self.product2.save()
+
+                line1 = sale.find_existing_line(self.product1.id)
+                line2 = sale.find_existing_line(self.product2.id)
+                self.assertEqual(
+                    self.Sale(sale.id).validate_cart_inventory(), [{
+                        'line': line1.id,
+                        'product': self.product1.id,
+                        'quantity': 5,
+                        'available_quantity': 10,
+                    }, {
+                        'line': line2.id,
+                        'product': self.product2.id,
+                        'quantity': 5,
+                        'available_quantity': 0,
+                    }]
+                )
+
+    def test_0080_default_price_list(self):
+        """
+        Test that the cached default price list follows the changes of the
+        channel and of the party
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            channel_price_list = self.channel.price_list
+            party = self.registered_user.party
+            user_price_list = party.sale_price_list
+
+            self.assertEqual(
+                self.Sale.default_price_list(), channel_price_list.id
+            )
+            self.SaleChannel.write(
+                [self.channel], {'price_list': user_price_list.id}
+            )
+            self.assertEqual(
+                self.Sale.default_price_list(), user_price_list.id
+            )
+            self.SaleChannel.write(
+                [self.channel], {'price_list': channel_price_list.id}
+            )
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    self.Sale.default_price_list(), channel_price_list.id
+                )
+
+            # The price list of the party of a logged in user
+            self.assertEqual(
+                self.Sale._get_default_price_list(party.id),
+                user_price_list.id
+            )
+            self.Party.write([party], {'sale_price_list': None})
+            self.assertEqual(
+                self.Sale._get_default_price_list(party.id),
+                channel_price_list.id
+            )
+
+    def test_0090_queued_purges(self):
+        """
+        Test that the keys purged outside a request are queued and kept
+        until they are sent
+        """
+        from trytond.modules.nereid_cart_b2c.purge import purge, \
+            set_surrogate_keys
+        from werkzeug.wrappers import Response
+
+        PurgeQueue = POOL.get('nereid.purge.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            if not config.has_section('nereid_cart'):
+                config.add_section('nereid_cart')
+            # Nothing listens there, so sending fails right away
+            config.set('nereid_cart', 'purge_url', 'http://127.0.0.1:1/')
+            try:
+                purge(['product-%d' % self.product1.id])
+                queued, = PurgeQueue.search([])
+                self.assertEqual(queued.key, 'product-%d' % self.product1.id)
+
+                PurgeQueue.send_queued()
+                self.assertEqual(PurgeQueue.search([], count=True), 1)
+
+                response = Response()
+                set_surrogate_keys(response, ['product-1'])
+                self.assertEqual(
+                    response.headers['Surrogate-Control'], 'max-age=86400'
+                )
+            finally:
+                config.remove_option('nereid_cart', 'purge_url')
+
 
 def suite():
     "Cart test suite"
@@ -8,6 +8,7 @@
     :license: GPLv3, see LICENSE for more details
 '''
 import json
+import datetime
 
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_product import BaseTestCase
@@ -49,3 +50,210 @@ class TestWebsite(BaseTestCase):
 
                 self.assertEqual(len(lines), 1)
                 self.assertEqual(line.serialize('cart'), lines[0])
+
+    def test_0020_update_cart_sale_dates(self):
+        """
+        Test that the sale date of stale carts is moved to today in bulk
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                rv = c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                self.assertEqual(rv.status_code, 302)
+
+            sale, = self.Sale.search([])
+            yesterday = Date.today() - datetime.timedelta(days=1)
+            self.Sale.write([sale], {'sale_date': yesterday})
+
+            cart, = self.Cart.search([])
+            self.assertTrue(cart.check_update_date())
+            # Checking the cart does not update the sale
+            self.assertEqual(self.Sale(sale.id).sale_date, yesterday)
+
+            self.Sale(sale.id).get_cart_summary()
+            self.assertIsNotNone(self.Sale(sale.id).total_amount_cache)
+            revision = cart.revision
+            self.NereidWebsite.update_cart_sale_dates()
+
+            self.assertEqual(self.Sale(sale.id).sale_date, Date.today())
+            self.assertIsNone(self.Sale(sale.id).total_amount_cache)
+            self.assertFalse(self.Cart(cart.id).check_update_date())
+            self.assertEqual(self.Cart(cart.id).revision, revision + 1)
+
+            # Carts which are up to date are left alone
+            self.NereidWebsite.update_cart_sale_dates()
+            self.assertEqual(self.Cart(cart.id).revision, revision + 1)
+
+    def test_0030_serialize_cart_lines(self):
+        """
+        Test that the lines serialized together are the same as the lines
+        serialized one by one.
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                SaleLine = POOL.get('sale.line')
+
+                for product in (self.product1, self.product2):
+                    rv = c.post(
+                        '/cart/add',
+                        data={
+                            'product': product.id, 'quantity': 7
+                        }
+                    )
+                    self.assertEqual(rv.status_code, 302)
+
+                lines = SaleLine.search([])
+                results = c.get('/user_status')
+
+                data = json.loads(results.data)
+                self.assertEqual(
+                    data['status']['cart']['lines'],
+                    [line.serialize('cart') for line in lines]
+                )
+
+    def test_0040_purge_abandoned_guest_carts(self):
+        """
+        Test that only the guest carts which have not changed for longer than
+        the retention are deleted, with their draft sales
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                rv = c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                self.assertEqual(rv.status_code, 302)
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+
+            guest_cart, = self.Cart.search([('user', '=', None)])
+            guest_sale_id = guest_cart.sale.id
+            self.assertEqual(self.Sale.search([], count=True), 2)
+
+            websites = self.NereidWebsite.search([])
+            self.NereidWebsite.write(websites, {'guest_cart_retention': 30})
+
+            # Nothing is old enough yet
+            self.assertEqual(
+                self.NereidWebsite.purge_abandoned_guest_carts(), 0
+            )
+
+            cart = self.Cart.__table__()
+            long_ago = datetime.datetime.now() - datetime.timedelta(days=31)
+            Transaction().cursor.execute(*cart.update(
+                columns=[cart.create_date, cart.write_date],
+                values=[long_ago, long_ago]
+            ))
+
+            # Guest carts are kept unless the website has a retention
+            self.NereidWebsite.write(websites, {'guest_cart_retention': None})
+            self.assertEqual(
+                self.NereidWebsite.purge_abandoned_guest_carts(), 0
+            )
+            self.NereidWebsite.write(websites, {'guest_cart_retention': 30})
+            self.assertEqual(
+                self.NereidWebsite.purge_abandoned_guest_carts(), 1
+            )
+            self.assertEqual(self.Cart.search([], count=True), 1)
+            self.assertFalse(self.Sale.search([('id', '=', guest_sale_id)]))
+            self.assertEqual(self.Sale.search([], count=True), 1)
+
+    def test_0050_cart_config(self):
+        """
+        Test that the cart configuration of a website is cached until the
+        website or its channel changes
+        """
+        SaleChannel = POOL.get('sale.channel')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            website, = self.NereidWebsite.search([])
+
+            config = website.get_cart_config()
+            self.assertEqual(config.channel, website.channel.id)
+            self.assertEqual(
+                config.stock_location,
+                website.channel.warehouse.storage_location.id
+            )
+            self.assertEqual(config.warehouse, website.warehouse.id)
+            self.assertEqual(config.payment_term, website.payment_term.id)
+            self.assertEqual(
+                config.guest_party, website.guest_user.party.id
+            )
+            self.assertIs(website.get_cart_config(), config)
+
+            SaleChannel.write([website.channel], {'name': 'Changed'})
+            self.assertIsNot(website.get_cart_config(), config)
+            config = website.get_cart_config()
+
+            self.NereidWebsite.write([website], {'name': 'changed'})
+            self.assertIsNot(website.get_cart_config(), config)
+
+    def test_0060_guest_sale_pool(self):
+        """
+        Test that guest carts claim the sales created in advance
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            website, = self.NereidWebsite.search([])
+
+            self.assertEqual(self.NereidWebsite.fill_guest_sale_pools(), 0)
+
+            self.NereidWebsite.write([website], {'guest_sale_pool_size': 2})
+            self.assertEqual(self.NereidWebsite.fill_guest_sale_pools(), 2)
+            pooled = self.Sale.search(
+                [('cart_pool', '=', True)], order=[('id', 'ASC')]
+            )
+            self.assertEqual(len(pooled), 2)
+
+            # The pooled sales get the current configuration when claimed
+            self.Sale.write(pooled, {
+                'sale_date': datetime.date.today() - datetime.timedelta(3),
+            })
+
+            with app.test_client() as c:
+                rv = c.post(
+                    '/cart/add',
+                    data={
+                        'product': self.product1.id, 'quantity': 7
+                    }
+                )
+                self.assertEqual(rv.status_code, 302)
+
+            cart, = self.Cart.search([])
+            self.assertEqual(cart.sale, pooled[0])
+            self.assertFalse(cart.sale.cart_pool)
+            self.assertEqual(cart.sale.sale_date, datetime.date.today())
+            self.assertEqual(len(cart.sale.lines), 1)
+            self.assertEqual(self.Sale.search([], count=True), 2)
+
+            # Only the claimed sale is created again
+            self.assertEqual(self.NereidWebsite.fill_guest_sale_pools(), 1)
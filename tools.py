@@ -0,0 +1,32 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.tools
+
+    Helpers for the updates which bypass the ORM
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from trytond.transaction import Transaction
+
+__all__ = ['clean_transaction_cache']
+
+
+def clean_transaction_cache(model_name, ids=None):
+    """
+    Clean the records of a model cached by the current transaction, the same
+    way a write or a delete by the ORM would. It must be called after the
+    records are changed by SQL queries run on the cursor.
+
+    :param model_name: Name of the model of the changed records
+    :param ids: IDs of the changed records, all the cached records of the
+                model are cleaned if not given
+    """
+    transaction = Transaction()
+    transaction.counter += 1
+    for records in transaction.cursor.cache.itervalues():
+        if ids is None:
+            records.pop(model_name, None)
+        elif model_name in records:
+            for id_ in ids:
+                records[model_name].pop(id_, None)
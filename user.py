@@ -0,0 +1,25 @@
+# -*- coding: UTF-8 -*-
+'''
+    nereid_cart.user
+
+    Clear the cached default price lists when the current channel of a user
+    changes
+
+    :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details
+'''
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['User']
+__metaclass__ = PoolMeta
+
+
+class User:
+    "User"
+    __name__ = 'res.user'
+
+    @classmethod
+    def write(cls, *args):
+        super(User, cls).write(*args)
+        if any('current_channel' in values for values in args[1::2]):
+            Pool().get('sale.sale').clear_default_price_list_cache()
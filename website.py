@@ -5,23 +5,41 @@
     :copyright: (c) 2010-2014 by Openlabs Technologies & Consulting (P) LTD
     :license: GPLv3, see LICENSE for more details
 '''
-from functools import partial
+import datetime
+import logging
+import time
+from collections import namedtuple
 
-from babel import numbers
 from nereid import render_template, login_required, request, current_user, \
     route
 from nereid.contrib.pagination import Pagination
 from nereid.globals import session
+from sql import Literal, Null
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
 from trytond import backend
+from trytond.cache import Cache
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.tools import reduce_ids
 from trytond.transaction import Transaction
 
+from .formatters import get_currency_format
+from .tools import clean_transaction_cache
 
-__all__ = ['Website']
+__all__ = ['Website', 'CartConfig']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+#: The configuration of a website used by the cart, as IDs. See
+#: :meth:`Website.get_cart_config`.
+CartConfig = namedtuple('CartConfig', [
+    'channel', 'warehouse', 'stock_location', 'payment_term', 'company',
+    'guest_user', 'guest_party', 'price_list',
+])
+
 
 class Website:
     """
@@ -80,11 +98,69 @@ class Website:
         'get_fields_from_channel'
     )
 
+    #: Number of days after which guest carts which have not changed are
+    #: deleted with their draft sales. They are never deleted if not set.
+    guest_cart_retention = fields.Integer(
+        'Guest Cart Retention', help='Number of days after which guest '
+        'carts which have not changed are deleted with their draft sales. '
+        'Leave empty to keep them.'
+    )
+
+    #: Number of draft guest cart sales created in advance for each
+    #: currency of the website, so that the first product added to a guest
+    #: cart does not have to create the sale. None are created if not set.
+    guest_sale_pool_size = fields.Integer(
+        'Guest Sale Pool Size', help='Number of draft guest cart sales '
+        'created in advance for each currency of the website.'
+    )
+
+    #: Keep the products added to guest carts in lightweight cart lines and
+    #: only create the sale when it is needed, like at checkout or when the
+    #: guest logs in. See :meth:`nereid.cart.stages_lines`.
+    stage_guest_carts = fields.Boolean(
+        'Stage Guest Carts', help='Keep the products added to guest carts '
+        'without creating a sale until checkout or login.'
+    )
+
+    #: Keep the quantities added to carts with a sale in a journal and
+    #: write them to the sale lines together, see
+    #: :meth:`nereid.cart.buffer_change`.
+    buffer_cart_changes = fields.Boolean(
+        'Buffer Cart Changes', help='Keep the products added to carts in a '
+        'journal and write them to the sale together.'
+    )
+    cart_buffer_size = fields.Integer(
+        'Cart Buffer Size', states={
+            'invisible': ~Eval('buffer_cart_changes'),
+        }, depends=['buffer_cart_changes'],
+        help='Number of buffered changes after which they are written to '
+        'the sale.'
+    )
+    cart_buffer_delay = fields.Integer(
+        'Cart Buffer Delay', states={
+            'invisible': ~Eval('buffer_cart_changes'),
+        }, depends=['buffer_cart_changes'],
+        help='Seconds after which the buffered changes are written to the '
+        'sale by the scheduler.'
+    )
+
+    _cart_config_cache = Cache(
+        'nereid.website.get_cart_config', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         super(Website, cls).__setup__()
         cls.per_page = 10
 
+    @staticmethod
+    def default_cart_buffer_size():
+        return 20
+
+    @staticmethod
+    def default_cart_buffer_delay():
+        return 30
+
     @classmethod
     def __register__(cls, module_name):
         super(Website, cls).__register__(module_name)
@@ -98,14 +174,224 @@ class Website:
         table.not_null_action('stock_location', action='remove')
         table.not_null_action('payment_term', action='remove')
 
+    @classmethod
+    def create(cls, vlist):
+        cls._cart_config_cache.clear()
+        return super(Website, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._cart_config_cache.clear()
+        super(Website, cls).write(*args)
+
+    @classmethod
+    def delete(cls, websites):
+        cls._cart_config_cache.clear()
+        super(Website, cls).delete(websites)
+
     def get_fields_from_channel(self, name):
         """
         Return the information from the channel assigned to the website.
         """
-        if name == 'stock_location':
-            return self.channel.warehouse.storage_location.id
+        return getattr(self.get_cart_config(), name)
 
-        return getattr(self.channel, name).id
+    def get_cart_config(self):
+        """
+        Return the :class:`CartConfig` of the website: its channel, the
+        warehouse, stock location, payment term and price list of the
+        channel, its company, guest user and the party of the guest user.
+
+        The configuration is built once per process and database and then
+        read from a cache, instead of walking the channel, warehouse and
+        guest user for each cart. The cache is cleared whenever a website or
+        a channel is changed.
+        """
+        config = self._cart_config_cache.get(self.id)
+        if config is not None:
+            return config
+
+        channel = self.channel
+        config = CartConfig(
+            channel=channel.id,
+            warehouse=channel.warehouse.id,
+            stock_location=channel.warehouse.storage_location.id,
+            payment_term=(
+                channel.payment_term and channel.payment_term.id
+            ),
+            company=self.company.id,
+            guest_user=self.guest_user.id,
+            guest_party=self.guest_user.party.id,
+            price_list=channel.price_list.id if channel.price_list else None,
+        )
+        self._cart_config_cache.set(self.id, config)
+        return config
+
+    @classmethod
+    def update_cart_sale_dates(cls):
+        """
+        Move the sale date of the open carts which are older than today to
+        today. A single update is run for each website, since the date of
+        today depends on the timezone of the company of the website.
+
+        This is run every night by the scheduler and replaces the update
+        which was previously done by the cart on the first request of the
+        day. The revision of the updated carts is incremented, so that their
+        ETag changes with their sale date.
+        """
+        Sale = Pool().get('sale.sale')
+        Cart = Pool().get('nereid.cart')
+        Date = Pool().get('ir.date')
+
+        sale = Sale.__table__()
+        cursor = Transaction().cursor
+
+        sale_ids = []
+        for website in cls.search([]):
+            with Transaction().set_context(company=website.company.id):
+                today = Date.today()
+            cursor.execute(*sale.select(
+                sale.id,
+                where=(
+                    (sale.website == website.id)
+                    & (sale.is_cart == Literal(True))
+                    & (sale.state == 'draft')
+                    & (sale.sale_date < today)
+                )
+            ))
+            website_sale_ids = [row[0] for row in cursor.fetchall()]
+            if not website_sale_ids:
+                continue
+            cursor.execute(*sale.update(
+                columns=[sale.sale_date, sale.write_uid, sale.write_date],
+                values=[today, Transaction().user, CurrentTimestamp()],
+                where=reduce_ids(sale.id, website_sale_ids)
+            ))
+            sale_ids.extend(website_sale_ids)
+
+        clean_transaction_cache(Sale.__name__)
+        # The taxes of the carts are computed at their sale date
+        Sale.clear_cart_cache(sale_ids)
+        Cart.bump_revision(sales=sale_ids)
+
+    @classmethod
+    def fill_guest_sale_pools(cls):
+        """
+        Create the draft guest cart sales missing from the pool of each
+        website and currency of its locales, up to the guest sale pool size
+        of the website. The sales are claimed by the guest carts with
+        :meth:`sale.sale.claim_pooled_cart_sale`.
+
+        This is run often by the scheduler.
+
+        :return: Number of sales created
+        """
+        Sale = Pool().get('sale.sale')
+
+        vlist = []
+        for website in cls.search([('guest_sale_pool_size', '>', 0)]):
+            config = website.get_cart_config()
+            currencies = set(
+                locale.currency.id for locale in website.locales
+            )
+            currencies.add(website.default_locale.currency.id)
+            for currency_id in currencies:
+                pooled = Sale.search([
+                    ('cart_pool', '=', True),
+                    ('website', '=', website.id),
+                    ('currency', '=', currency_id),
+                    ('state', '=', 'draft'),
+                ], count=True)
+                vlist.extend({
+                    'party': config.guest_party,
+                    'currency': currency_id,
+                    'company': config.company,
+                    'is_cart': True,
+                    'cart_pool': True,
+                    'state': 'draft',
+                    'website': website.id,
+                    'nereid_user': config.guest_user,
+                    'warehouse': config.warehouse,
+                    'payment_term': config.payment_term,
+                    'price_list': config.price_list,
+                } for i in xrange(website.guest_sale_pool_size - pooled))
+        if vlist:
+            Sale.create(vlist)
+        return len(vlist)
+
+    @classmethod
+    def purge_abandoned_guest_carts(cls, chunk_size=500, commit=False):
+        """
+        Delete the guest carts which have not changed for more than the
+        guest cart retention of their website, with their draft sales.
+
+        The carts are processed in chunks ordered by their ID. The draft
+        sales of a chunk are cancelled and deleted together and then the
+        carts are, instead of clearing the carts one by one. The sales which
+        are no longer drafts, like the orders of guests who checked out, are
+        kept.
+
+        :param chunk_size: Number of carts deleted per chunk
+        :param commit: If True the transaction is committed after each chunk
+        :return: Number of carts deleted
+        """
+        Cart = Pool().get('nereid.cart')
+        Sale = Pool().get('sale.sale')
+
+        cart = Cart.__table__()
+        sale = Sale.__table__()
+        cursor = Transaction().cursor
+
+        done, start = 0, time.time()
+        for website in cls.search([('guest_cart_retention', '>', 0)]):
+            limit_date = datetime.datetime.now() - datetime.timedelta(
+                days=website.guest_cart_retention
+            )
+            last_id = 0
+            while True:
+                cursor.execute(*cart.join(
+                    sale, 'LEFT', condition=cart.sale == sale.id
+                ).select(
+                    cart.id, sale.id, sale.state, sale.is_cart,
+                    where=(
+                        (cart.website == website.id)
+                        & (cart.user == Null)
+                        & (Coalesce(cart.write_date, cart.create_date)
+                            < limit_date)
+                        & (cart.id > last_id)
+                    ),
+                    order_by=cart.id.asc, limit=chunk_size
+                ))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                Cart.delete(Cart.browse([row[0] for row in rows]))
+                sales = Sale.browse([
+                    sale_id for cart_id, sale_id, state, is_cart in rows
+                    if sale_id and state == 'draft' and is_cart
+                ])
+                if sales:
+                    Sale.cancel(sales)
+                    Sale.delete(sales)
+
+                last_id = rows[-1][0]
+                done += len(rows)
+                logger.info(
+                    'Purged %d abandoned guest carts (%.1f carts/s, last '
+                    'cart ID: %d)', done, done / (time.time() - start),
+                    last_id
+                )
+                if commit:
+                    cursor.commit()
+        return done
+
+    @classmethod
+    def purge_abandoned_guest_carts_from_cron(cls):
+        """
+        Purge the abandoned guest carts of all the websites. Called by the
+        scheduler.
+        """
+        return cls.purge_abandoned_guest_carts(commit=True)
 
     @classmethod
     def account_context(cls):
@@ -215,7 +501,8 @@ class Website:
         # This behaviour needs serious improvement. Probably create a new cart
         # with all items in this cart and then drop this one
         cart = Cart.open_cart()
-        if cart.sale and cart.sale.currency.id != session['currency']:
+        if (cart.sale or (cart.id is not None and cart.lines)) and \
+                cart.get_currency().id != session['currency']:
             Cart.clear_cart()
 
         return rv
@@ -225,31 +512,31 @@ class Website:
         """Add cart size and amount to the dictionary
         """
         Cart = Pool().get('nereid.cart')
+
         cart = Cart.open_cart()
 
         rv = super(Website, cls)._user_status()
 
-        if cart.sale:
-            # Build locale based formatters
-            currency_format = partial(
-                numbers.format_currency, currency=cart.sale.currency.code,
-                locale=request.nereid_language.code
+        # With the changes buffered in the session, or the staged lines if
+        # the cart has no sale
+        summary = cart.get_summary()
+        if cart.sale or summary['lines']:
+            currency = cart.get_currency()
+            # Get the locale based formatter
+            currency_format = get_currency_format(
+                currency.code, request.nereid_language.code
             )
 
             rv['cart'] = {
-                'lines': [
-                    line.serialize(purpose='cart')
-                    for line in cart.sale.lines
-                ],
-                'empty': len(cart.sale.lines) > 0,
-                'total_amount': currency_format(cart.sale.total_amount),
-                'tax_amount': currency_format(cart.sale.tax_amount),
-                'untaxed_amount': currency_format(cart.sale.untaxed_amount),
+                'lines': cart.serialize_lines(),
+                'empty': summary['lines'] > 0,
+                'total_amount': currency_format(summary['total_amount']),
+                'tax_amount': currency_format(summary['tax_amount']),
+                'untaxed_amount': currency_format(summary['untaxed_amount']),
             }
             rv['cart_total_amount'] = currency_format(
-                cart.sale and cart.sale.total_amount or 0
+                summary['total_amount'] or 0
             )
-
-        rv['cart_size'] = '%s' % Cart.cart_size()
+        rv['cart_size'] = '%s' % summary['quantity']
 
         return rv